@@ -0,0 +1,99 @@
+# Public Python libraries
+import asyncio
+import random
+import types
+
+os_pool = [
+    "Debian GNU/Linux 12 (bookworm)",
+    "Debian GNU/Linux 11 (bullseye)",
+    "Ubuntu 24.04.3 LTS",
+    "Ubuntu 22.04.5 LTS",
+    "Microsoft Windows 11 Pro - 24H2/26100"
+]
+
+class FakeSession:
+    def __init__(self,
+                 nodes: int = 10000,
+                 groups: int = 50,
+                 offline_ratio: float = 0.05,
+                 output_lines: int = 20,
+                 line_length: int = 60,
+                 latency_ms: float = 0.0,
+                 latency_distribution: str = "fixed",
+                 seed: int = 1) -> None:
+        '''
+        Stand-in for meshctrl.Session with a synthetic inventory, so meshbook can be measured at fleet scale without a MeshCentral server.
+        Only list_devices, run_command and close are implemented, with the same return shapes as libmeshctrl.
+        Like libmeshctrl (Session.events()), every answer is delivered to every run_command that is running at that moment,
+        which filters out its own devices, so many concurrent single device calls cost what they cost against a real server.
+
+        latency_distribution: "fixed" (every device takes latency_ms), "uniform" (0 - 2x latency_ms) or "lognormal" (median latency_ms, long tail).
+        '''
+        self.random = random.Random(seed)
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.run_command_calls = 0
+        self.subscribers = set() # The event filter of every running run_command.
+        self.event_deliveries = 0
+
+        self.devices = []
+        for index in range(nodes):
+            self.devices.append(types.SimpleNamespace(
+                nodeid=f"node//fake{index:08d}",
+                name=f"host-{index:06d}",
+                meshname=f"Group {index % groups}",
+                os_description=os_pool[index % len(os_pool)],
+                tags=["production"] if index % 3 == 0 else ["staging"],
+                connected=self.random.random() >= offline_ratio
+            ))
+
+        line = "x" * line_length
+        self.output = "\n".join(f"{number} {line}" for number in range(output_lines)) + "\nRun commands completed."
+
+    def latency(self) -> float:
+        match self.latency_distribution:
+            case "uniform":
+                return self.random.uniform(0, 2 * self.latency_ms) / 1000
+            case "lognormal":
+                return self.random.lognormvariate(0, 1) * self.latency_ms / 1000
+            case _:
+                return self.latency_ms / 1000
+
+    async def list_devices(self, details: bool = False, group: str | None = None, meshid: str | None = None, timeout: int | None = None) -> list:
+        if group is not None:
+            return [device for device in self.devices if device.meshname == group]
+        return list(self.devices)
+
+    async def run_command(self, nodeids, command, powershell=False, runasuser=False, runasuseronly=False, ignore_output=False, timeout=None) -> dict:
+        if isinstance(nodeids, str):
+            nodeids = [nodeids]
+        self.run_command_calls += 1
+
+        wanted = set(nodeids)
+        received = {}
+
+        def subscriber(nodeid: str, response: dict) -> None:
+            if nodeid in wanted:
+                received[nodeid] = response
+
+        self.subscribers.add(subscriber)
+        try:
+            # Like the real call, it only returns when the slowest device answered, or raises when that takes longer than timeout.
+            if self.latency_ms > 0 and len(nodeids) > 0:
+                latency = max(self.latency() for _ in nodeids)
+                if timeout is not None and latency > timeout:
+                    await asyncio.sleep(timeout)
+                    raise asyncio.TimeoutError()
+                await asyncio.sleep(latency)
+
+            for nodeid in nodeids:
+                self.event_deliveries += len(self.subscribers)
+                for deliver in self.subscribers:
+                    deliver(nodeid, {"complete": True, "result": self.output, "command": command})
+        finally:
+            self.subscribers.discard(subscriber)
+
+        return received
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,141 @@
+#!/bin/python3
+
+# Public Python libraries
+import argparse
+import asyncio
+import copy
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+# Local Python libraries/modules
+from benchmarks.fake_session import FakeSession
+from modules.executor import Executor
+from modules.history import History
+from modules.os_matcher import OsMatcher
+from modules.utilities import Transform, Utilities
+
+def define_cmdargs() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Measure how meshbook stages scale against a simulated MeshCentral session.")
+
+    parser.add_argument("--nodes", type=int, nargs="+", help="Fleet sizes to measure (default: 10000 100000).", default=[10000, 100000])
+    parser.add_argument("--groups", type=int, help="Number of device groups (default: 50).", default=50)
+    parser.add_argument("--offline-ratio", type=float, help="Share of devices that is offline (default: 0.05).", default=0.05)
+    parser.add_argument("--output-lines", type=int, help="Lines of output per device and task (default: 20).", default=20)
+    parser.add_argument("--line-length", type=int, help="Characters per output line (default: 60).", default=60)
+    parser.add_argument("--latency-ms", type=float, help="Simulated device response time in milliseconds (default: 0).", default=0.0)
+    parser.add_argument("--latency-distribution", type=str, choices=["fixed", "uniform", "lognormal"], help="Distribution of the device response times (default: fixed).", default="fixed")
+    parser.add_argument("--tasks", type=int, help="Tasks in the simulated meshbook (default: 2).", default=2)
+    parser.add_argument("--strategy", type=str, choices=["linear", "pipelined"], help="Executor strategy to measure (default: linear).", default="linear")
+    parser.add_argument("--shlex", action="store_true", help="Measure the post-processing with shlex enabled.")
+    parser.add_argument("--timeout", type=float, help="Seconds a device gets to answer a task (timeout in the meshbook).")
+    parser.add_argument("--quorum", type=str, help="Cut off the stragglers once this many devices answered, a count or a percentage like 98%% (quorum in the meshbook).")
+    parser.add_argument("--max-in-flight", type=int, help="Devices dispatched at once (max_in_flight in the meshbook).")
+    parser.add_argument("--aggregate", action="store_true", help="Store identical device outputs once (aggregate: true in the meshbook).")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory tracking (tracemalloc slows everything down).")
+    parser.add_argument("--oscategories", type=str, help="Path to the Operating System categories JSON file.", default="./os_categories.json")
+    parser.add_argument("--json", type=str, help="Also write the results to this JSON file, for comparing runs.")
+
+    return parser
+
+async def measure(results: list[dict], nodes: int, stage: str, track_memory: bool, stage_coroutine):
+    '''
+    Run a single stage and record its wall time and (optionally) its peak Python memory.
+    '''
+
+    gc.collect()
+    if track_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    outcome = await stage_coroutine
+    wall_time = time.perf_counter() - start
+
+    peak_memory = None
+    if track_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    results.append({"nodes": nodes, "stage": stage, "wall_time_s": round(wall_time, 4), "peak_memory_mb": None if peak_memory is None else round(peak_memory / 1024 / 1024, 2)})
+    print(f"{nodes:>8} {stage:<28} {wall_time:>10.3f}s {'-' if peak_memory is None else f'{peak_memory / 1024 / 1024:.1f} MB':>12}")
+    return outcome
+
+async def write_history(history: History, complete_log: dict) -> None:
+    history.write_history(json.dumps(complete_log), f"benchmark_{time.time_ns()}")
+
+async def run_stream(session: FakeSession, compiled_device_list: dict, meshbook: dict, inventory, history: History, enable_shlex: bool) -> None:
+    stream = history.open_stream("benchmark", meshbook["tasks"], True, None, f"benchmark_{time.time_ns()}")
+    try:
+        await Executor.execute_meshbook(True, enable_shlex, session, compiled_device_list, meshbook, inventory, stream)
+    finally:
+        stream.close()
+
+async def process_shell_response(enable_shlex: bool, raw_log: dict) -> dict:
+    return Transform.process_shell_response(enable_shlex, raw_log)
+
+async def benchmark(args: argparse.Namespace, nodes: int, os_matcher: OsMatcher, history: History, results: list[dict]) -> None:
+    track_memory = not args.no_memory
+    session = FakeSession(nodes, args.groups, args.offline_ratio, args.output_lines, args.line_length, args.latency_ms, args.latency_distribution)
+
+    meshbook = {
+        "name": "benchmark",
+        "groups": [f"Group {index}" for index in range(args.groups)],
+        "target_os": "Linux",
+        "strategy": args.strategy,
+        "aggregate": args.aggregate,
+        "task_delay": 0,
+        "tasks": [{"name": f"task {index + 1}", "command": "cat /var/log/syslog"} for index in range(args.tasks)]
+    }
+    if args.timeout is not None:
+        meshbook["timeout"] = args.timeout
+    if args.quorum is not None:
+        meshbook["quorum"] = args.quorum
+    if args.max_in_flight is not None:
+        meshbook["max_in_flight"] = args.max_in_flight
+
+    inventory = await measure(results, nodes, "compile_group_list", track_memory, Transform.compile_group_list(session))
+    compiled_device_list = await measure(results, nodes, "gather_targets", track_memory, Utilities.gather_targets(True, meshbook, inventory, os_matcher))
+
+    complete_log = await measure(results, nodes, "execute_meshbook", track_memory,
+                                 Executor.execute_meshbook(True, args.shlex, session, copy.deepcopy(compiled_device_list), meshbook, inventory))
+    await measure(results, nodes, "execute_meshbook (stream)", track_memory,
+                  run_stream(session, copy.deepcopy(compiled_device_list), meshbook, inventory, history, args.shlex))
+
+    # Raw (unprocessed) log of the same size, to compare with a single post-processing pass over the whole log.
+    raw_log = {}
+    for task_key, task_data in complete_log.items():
+        if task_key.startswith("task_"):
+            raw_log[task_key] = {"task_name": task_data["task_name"], "data": [{**response, "result": session.output} for response in task_data["data"]]}
+    await measure(results, nodes, "process_shell_response", track_memory, process_shell_response(args.shlex, raw_log))
+    del raw_log
+
+    await measure(results, nodes, "write_history", track_memory, write_history(history, complete_log))
+    print(f"{nodes:>8} {'run_command calls':<28} {session.run_command_calls:>11} {'events':>12} {session.event_deliveries}")
+
+async def main() -> None:
+    args = define_cmdargs().parse_args()
+
+    with open(args.oscategories, "r") as file:
+        os_matcher = OsMatcher(json.load(file))
+
+    results = []
+    with tempfile.TemporaryDirectory() as history_directory:
+        history = History(True, history_directory, False)
+
+        print(f"{'nodes':>8} {'stage':<28} {'wall time':>11} {'peak memory':>12}")
+        for nodes in args.nodes:
+            await benchmark(args, nodes, os_matcher, history, results)
+            for item in os.listdir(history_directory): # Keep the disk usage of large runs in check.
+                os.remove(os.path.join(history_directory, item))
+
+    Transform.close_shlex_pool()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=4)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+#!/bin/python3
+
+# Public Python libraries
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# This module is also the child process that is measured, everything the parent needs on top is imported in the parent functions.
+
+scenarios = ("version", "validate", "run")
+
+meshbook_yaml = '''name: startup benchmark
+group: "Group 0"
+task_delay: 0
+tasks:
+  - name: uptime
+    command: "uptime"
+  - name: hostname
+    command: "hostname"
+'''
+
+credentials_conf = '''[meshcentral-account]
+hostname = meshcentral.invalid
+username = benchmark
+password = benchmark
+'''
+
+class StopBeforeLogin(Exception):
+    pass
+
+def define_cmdargs() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Measure the cold start of meshbook, every sample is a fresh Python process.")
+
+    parser.add_argument("--scenarios", type=str, nargs="+", choices=scenarios, help="What to measure: version (--version), validate (read and check a meshbook, up to the login) and run (a whole run against a FakeSession) (default: all).", default=list(scenarios))
+    parser.add_argument("--repeat", type=int, help="Fresh processes per scenario (default: 10).", default=10)
+    parser.add_argument("--nodes", type=int, help="Devices in the FakeSession of the run scenario (default: 100).", default=100)
+    parser.add_argument("--oscategories", type=str, help="Path to the Operating System categories JSON file.", default="./os_categories.json")
+    parser.add_argument("--json", type=str, help="Also write the results to this JSON file, for comparing runs.")
+
+    parser.add_argument("--child", type=str, choices=scenarios[1:], help=argparse.SUPPRESS)
+
+    return parser
+
+def run_child(scenario: str, nodes: int, meshbook_args: list[str]) -> None:
+    '''
+    Run meshbook.main in this process, with the login replaced: validate stops right before it, run logs in to a FakeSession.
+    '''
+
+    import meshbook
+
+    async def stop_before_login(servers: dict) -> None:
+        raise StopBeforeLogin()
+
+    async def fake_login(servers: dict):
+        from benchmarks.fake_session import FakeSession
+        return FakeSession(nodes, 1, 0.0, 5, 60)
+
+    meshbook.init_servers = stop_before_login if scenario == "validate" else fake_login
+    sys.argv = ["meshbook.py", *meshbook_args]
+    try:
+        asyncio.run(meshbook.main())
+    except StopBeforeLogin:
+        pass
+
+def measure(command: list[str], repeat: int) -> list[float]:
+    '''
+    Wall time of every fresh process, a failing process stops the benchmark instead of measuring an error path.
+    '''
+
+    import subprocess
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        samples.append(time.perf_counter() - start)
+        if completed.returncode != 0:
+            raise RuntimeError(f"{' '.join(command)} exited with {completed.returncode}:\n{completed.stderr}")
+    return samples
+
+def main() -> None:
+    args, meshbook_args = define_cmdargs().parse_known_args()
+
+    if args.child:
+        run_child(args.child, args.nodes, meshbook_args)
+        return
+
+    import json
+    import statistics
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        meshbook_file = os.path.join(work_directory, "startup.yaml")
+        with open(meshbook_file, "w") as f:
+            f.write(meshbook_yaml)
+        credentials_file = os.path.join(work_directory, "api.conf")
+        with open(credentials_file, "w") as f:
+            f.write(credentials_conf)
+
+        book_args = ["-mb", meshbook_file, "--conf", credentials_file, "-oc", os.path.abspath(args.oscategories),
+                     "--cachedir", os.path.join(work_directory, "cache"),
+                     "--historydir", os.path.join(work_directory, "history"), "--nograce", "--nohistory", "--silent"]
+        commands = {
+            "interpreter": [sys.executable, "-c", "pass"],
+            "version": [sys.executable, "meshbook.py", "--version"],
+            "validate": [sys.executable, "-m", "benchmarks.startup_benchmark", "--child", "validate", *book_args],
+            "run": [sys.executable, "-m", "benchmarks.startup_benchmark", "--child", "run", "--nodes", str(args.nodes), *book_args]
+        }
+
+        results = []
+        print(f"{'scenario':<12} {'median':>10} {'min':>10} {'max':>10}")
+        for scenario in ["interpreter", *args.scenarios]:
+            samples = measure(commands[scenario], args.repeat)
+            results.append({"scenario": scenario,
+                            "median_s": round(statistics.median(samples), 4),
+                            "min_s": round(min(samples), 4),
+                            "max_s": round(max(samples), 4)})
+            print(f"{scenario:<12} {statistics.median(samples):>9.3f}s {min(samples):>9.3f}s {max(samples):>9.3f}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"parameters": vars(args), "python": sys.version, "results": results}, f, indent=4)
+
+if __name__ == "__main__":
+    main()
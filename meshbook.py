@@ -1,18 +1,28 @@
 #!/bin/python3
 
 # Public Python libraries
+from __future__ import annotations
 import argparse
 import asyncio
-from colorama import just_fix_windows_console
-import pyotp
-import json
-import meshctrl
+import os
+import time
+from typing import TYPE_CHECKING
 
 # Local Python libraries/modules
 from modules.console import Console
-from modules.executor import Executor
-from modules.history import History
-from modules.utilities import Transform, Utilities
+from modules.metrics import Metrics
+from modules.profiler import Profiler
+
+# meshctrl, pyotp, yaml and the rest of the modules are imported by the code paths that use them,
+# so --version, --help and mistakes on the command line answer without loading them.
+if TYPE_CHECKING:
+    import meshctrl
+    from modules.checkpoint import Checkpoint
+    from modules.federation import Federation
+    from modules.history import History, OutputSpill
+    from modules.inventory import Inventory
+    from modules.os_matcher import OsMatcher
+    from modules.session_pool import SessionPool
 
 meshbook_version = "1.3.2"
 grace_period = 3 # Grace period will last for x (by default 3) second(s).
@@ -20,14 +30,34 @@ grace_period = 3 # Grace period will last for x (by default 3) second(s).
 def define_cmdargs() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Process command-line arguments")
 
-    parser.add_argument("-mb", "--meshbook", type=str, help="Path to the meshbook yaml file.")
+    parser.add_argument("action", nargs="*", help="Optional action: 'serve' runs meshbook as a daemon that accepts jobs (see --socket and --listen), 'history query' searches the sqlite history (filters: -mb, -d, --task, --since, --status, --limit).")
+
+    parser.add_argument("-mb", "--meshbook", type=str, help="Path to the meshbook yaml file, a directory of meshbooks, a glob pattern or a manifest file.")
+    parser.add_argument("--parallel", type=int, help="How many meshbooks of a batch run at the same time (default: 1, in order).", default=1)
 
     parser.add_argument("--historydir", type=str, help="Define a custom history log directory (default: ./history).", default="./history")
     parser.add_argument("--nohistory", action="store_true", help="Disable the logging of the history into a local log (text) file inside './history'.")
     parser.add_argument("--flushhistory", action="store_true", help="Clear old history logs before running the Meshbook.")
+    parser.add_argument("--stream", action="store_true", help="Stream every result to the history file (NDJSON) as soon as it arrives instead of keeping the whole run in memory.")
+    parser.add_argument("--resume", type=str, help="Resume an interrupted or partially failed run by its run id, only the tasks that did not complete on a device are dispatched again.")
+    parser.add_argument("--rebuild", type=str, help="Print a streamed (NDJSON) history file in the regular JSON layout and exit.")
+    parser.add_argument("--history-max-age", type=float, help="Remove history older than this many days, 0 keeps everything (default: 0).", default=0)
+    parser.add_argument("--history-max-count", type=int, help="Keep at most this many history files (or sqlite runs), 0 keeps everything (default: 0).", default=0)
+    parser.add_argument("--history-max-mb", type=float, help="Remove the oldest history files until they take at most this many megabytes, 0 disables the budget (default: 0).", default=0)
+    parser.add_argument("--history-compress-after", type=float, help="Gzip history files older than this many days into dated subdirectories, 0 disables compression (default: 0).", default=0)
+    parser.add_argument("--history-backend", type=str, choices=["files", "sqlite"], help="Write a history file per run (files) or store every run in <historydir>/history.sqlite3 (sqlite) (default: files).", default="files")
+
+    parser.add_argument("--task", type=str, help="History query: only results of the task with this name.", default="")
+    parser.add_argument("--since", type=str, help="History query: only results of runs since a relative age (30d, 12h, 15m) or an ISO date.", default="")
+    parser.add_argument("--status", type=str, choices=["complete", "failed"], help="History query: only completed or only failed results (default: both).", default="")
+    parser.add_argument("--limit", type=int, help="History query: maximum number of results, newest first (default: 100).", default=100)
 
     parser.add_argument("-oc", "--oscategories", type=str, help="Path to the Operating System categories JSON file.", default="./os_categories.json")
     parser.add_argument("--conf", type=str, help="Path for the API configuration file (default: ./config.conf).", default="./api.conf")
+    parser.add_argument("--cachedir", type=str, help="Define a custom inventory cache directory (default: ./cache).", default="./cache")
+    parser.add_argument("--inventory-ttl", type=int, help="Seconds a cached device inventory is trusted, 0 disables the cache (default: 0).", default=0)
+    parser.add_argument("--inventory-state", type=str, choices=["live", "cache"], help="Refresh the connection state of the targeted groups from MeshCentral (live) or trust the cached state (cache) (default: live).", default="live")
+    parser.add_argument("--refresh-inventory", action="store_true", help="Ignore the cached inventory and fetch the full device list.")
     parser.add_argument("--nograce", action="store_true", help="Disable the grace 3 seconds before running the meshbook.")
 
     parser.add_argument("-g", "--group", type=str, help="Specify a manual override for the group.", default="")
@@ -36,15 +66,68 @@ def define_cmdargs() -> argparse.ArgumentParser:
     parser.add_argument("-s", "--silent", action="store_true", help="Suppress terminal output.", default=False)
     parser.add_argument("--shlex", action="store_true", help="Shlex the lines. (SHell LEXical Analysis)", default=False)
 
+    parser.add_argument("--socket", type=str, help="Serve: path of the Unix socket to accept jobs on.")
+    parser.add_argument("--listen", type=int, help="Serve: localhost port to accept jobs on, needs --token-file.")
+    parser.add_argument("--token-file", type=str, help="Serve: file with the token clients send as 'Authorization: Bearer <token>', required with --listen.")
+    parser.add_argument("--books-dir", type=str, help="Serve: directory the 'meshbook' paths of jobs have to be in, without it jobs can only send the meshbook content.")
+    parser.add_argument("--refresh-interval", type=int, help="Serve: seconds between two full inventory refreshes (default: 300).", default=300)
+
+    parser.add_argument("--profile", type=str, nargs="?", const="./profile", help="Record timed spans of every phase, task and device response and write them to <path>.spans.json and <path>.trace.json (Chrome trace format) (default path: ./profile).")
+
+    parser.add_argument("--metrics-textfile", type=str, help="Write run, task and device metrics (Prometheus text format) to this file, for the node_exporter textfile collector.")
+    parser.add_argument("--metrics-push", type=str, help="PUT run, task and device metrics (Prometheus text format) to this URL, like http://localhost:9091/metrics/job/meshbook.")
+
     parser.add_argument("--version", action="store_true", help="Show the Meshbook version.")
 
     return parser
 
-async def init_connection(credentials: dict) -> meshctrl.Session:
+async def init_connection(credentials: dict) -> meshctrl.Session | SessionPool:
+    '''
+    Open the connection(s) to the MeshCentral instance, with "connections" above 1 in the configuration file
+    that many sessions are opened at once and combined into a SessionPool.
+    '''
+
+    from modules.session_pool import SessionPool
+
+    connections = int(credentials.get("connections") or 1)
+    if connections <= 1:
+        return await open_session(credentials)
+
+    return SessionPool(await connect_all([open_session(credentials) for _ in range(connections)]))
+
+async def init_servers(servers: dict[str, dict]) -> meshctrl.Session | SessionPool | Federation:
+    '''
+    Connect to every configured MeshCentral server at once, several servers are combined into a Federation.
+    '''
+
+    from modules.federation import Federation
+
+    if len(servers) == 1:
+        return await init_connection(next(iter(servers.values())))
+
+    sessions = await connect_all([init_connection(credentials) for credentials in servers.values()])
+    return Federation(dict(zip(servers, sessions)))
+
+async def connect_all(connecting: list) -> list:
+    '''
+    Await the connection attempts at once, when one of them fails the ones that did connect are closed and its error is raised.
+    '''
+
+    sessions = await asyncio.gather(*connecting, return_exceptions=True)
+    failures = [session for session in sessions if isinstance(session, BaseException)]
+    if len(failures) > 0: # Do not leave the connections that did succeed open.
+        await asyncio.gather(*(session.close() for session in sessions if not isinstance(session, BaseException)))
+        raise failures[0]
+    return sessions
+
+async def open_session(credentials: dict) -> meshctrl.Session:
     '''
     Use the libmeshctrl library to initiate a Secure Websocket (wss) connection to the MeshCentral instance.
     '''
 
+    import meshctrl
+    import pyotp
+
     if "totp_secret" in credentials:
         totp = pyotp.TOTP(credentials["totp_secret"])
         otp = totp.now()
@@ -64,8 +147,299 @@ async def init_connection(credentials: dict) -> meshctrl.Session:
     await session.initialized.wait()
     return session
 
+def print_book_info(args: argparse.Namespace, meshbook_file: str, meshbook: dict) -> None:
+    '''
+    Displays the used variables of a single meshbook to the Console.
+    '''
+
+    # INIT ARGUMENTS PRINTING
+    Console.print_line(args.silent)
+    Console.print_text(args.silent,
+                       "meshbook: " + Console.text_color.yellow + meshbook_file + Console.text_color.reset + ".")
+    Console.print_text(args.silent,
+                       "Operating System Categorisation file: " + Console.text_color.yellow + args.oscategories + Console.text_color.reset + ".")
+    Console.print_text(args.silent,
+                       "Configuration file: " + Console.text_color.yellow + args.conf + Console.text_color.reset + ".")
+
+    # TARGET OS PRINTING
+    if "target_os" in meshbook:
+        Console.print_text(args.silent,
+                           "Target Operating System category given: " + Console.text_color.yellow + meshbook["target_os"] + Console.text_color.reset + ".")
+    else:
+        Console.print_text(args.silent,
+                           "Target Operating System category given: " + Console.text_color.yellow + "All" + Console.text_color.reset + ".")
+
+    # Should Meshbook ignore categorisation?
+    if "ignore_categorisation" in meshbook:
+        Console.print_text(args.silent,
+                            "Ignore the OS Categorisation file: " + Console.text_color.yellow + str(meshbook["ignore_categorisation"]) + Console.text_color.reset + ".")
+        if meshbook["ignore_categorisation"]:
+            Console.print_text(args.silent,
+                            Console.text_color.red + "!!!!\n" +
+                            Console.text_color.yellow + 
+                            "Ignore categorisation is True.\nThis means that the program checks if the target Operating System is somewhere in the reported device Operating System." + 
+                            Console.text_color.red + "\n!!!!")
+    else:
+        Console.print_text(args.silent,
+                            "Ignore the OS Categorisation file: " + Console.text_color.yellow + "False" + Console.text_color.reset + ".")
+
+    # TARGET TAG PRINTING
+    if "target_tag" in meshbook:
+        Console.print_text(args.silent,
+                           "Target Device tag given: " + Console.text_color.yellow + meshbook["target_tag"] + Console.text_color.reset + ".")
+    else:
+        Console.print_text(args.silent,
+                           "Target Device tag given: " + Console.text_color.yellow + "All" + Console.text_color.reset + ".")
+
+    # TARGET PRINTING
+    if "targets" in meshbook:
+        Console.print_text(args.silent,
+                           "Target selection: " + Console.text_color.yellow + str(meshbook["targets"]) + Console.text_color.reset + ".")
+    elif "device" in meshbook:
+        Console.print_text(args.silent,
+                           "Target device: " + Console.text_color.yellow + str(meshbook["device"]) + Console.text_color.reset + ".")
+    elif "devices" in meshbook:
+        Console.print_text(args.silent,
+                           "Target devices: " + Console.text_color.yellow + str(meshbook["devices"]) + Console.text_color.reset + ".")
+    elif "group" in meshbook:
+        Console.print_text(args.silent,
+                           "Target group: " + Console.text_color.yellow + str(meshbook["group"]) + Console.text_color.reset + ".")
+    elif "groups" in meshbook:
+        Console.print_text(args.silent,
+                           "Target groups: " + Console.text_color.yellow + str(meshbook["groups"]) + Console.text_color.reset + ".")
+
+async def grace(args: argparse.Namespace) -> None:
+    if not args.nograce:
+        Console.print_text(args.silent,
+                            Console.text_color.yellow + "Initiating grace-period...")
+
+        for x in range(grace_period):
+            Console.print_text(args.silent,
+                                Console.text_color.yellow + "{}...".format(x+1)) # Countdown!
+            await asyncio.sleep(1)
+
+async def run_book(args: argparse.Namespace,
+                   session: meshctrl.Session,
+                   inventory: Inventory,
+                   os_matcher: OsMatcher,
+                   history: History,
+                   meshbook_file: str,
+                   meshbook: dict,
+                   history_name: str | None = None,
+                   with_grace: bool = True) -> None:
+    '''
+    Resolve the targets of a single meshbook, run it and write its history.
+    '''
+
+    from modules.checkpoint import Checkpoint
+    from modules.history import OutputSpill
+    from modules.utilities import Utilities
+
+    with Profiler.span("gather_targets", meshbook=meshbook_file):
+        compiled_device_list = await Utilities.gather_targets(args.silent, meshbook, inventory, os_matcher)
+
+    # Check if we have reachable targets on the MeshCentral host
+    if "target_list" not in compiled_device_list or len(compiled_device_list["target_list"]) == 0:
+        Console.print_text(args.silent,
+                           Console.text_color.red + f"No targets found or targets unreachable for {meshbook_file}, quitting.")
+
+        Console.print_line(args.silent)
+        return
+
+    Console.print_line(args.silent)
+
+    match meshbook:
+        case {"targets": candidate_target_name}:
+            target_name = str(candidate_target_name)
+
+        case {"group": candidate_target_name}:
+            target_name = candidate_target_name
+
+        case {"groups": candidate_target_name}:
+            target_name = str(candidate_target_name)
+
+        case {"device": candidate_target_name}:
+            target_name = candidate_target_name
+
+        case {"devices": candidate_target_name}:
+            target_name = str(candidate_target_name)
+
+        case _:
+            target_name = ""
+
+    # From here on the actual exection happens
+    Console.print_text(args.silent,
+                        Console.text_color.yellow + "Executing meshbook on the target(s): " + Console.text_color.green + target_name + Console.text_color.yellow + ".")
+
+    if with_grace:
+        await grace(args)
+
+    indent = None
+    if args.indent: indent = 4
+
+    spill = None
+    checkpoint = None
+    if not args.nohistory:
+        spill = OutputSpill(history.spill_directory(history_name))
+        checkpoint = Checkpoint(args.silent, f"{args.historydir}/checkpoints", args.resume, meshbook_file, args.group, args.device)
+        Console.print_text(args.silent, "Run id: " + Console.text_color.yellow + checkpoint.run_id + Console.text_color.reset + ".")
+
+    try:
+        await execute_book(args, session, inventory, history, meshbook_file, meshbook, compiled_device_list, history_name, indent, spill, checkpoint)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+            if not checkpoint.finished:
+                Console.print_text(args.silent,
+                                   Console.text_color.yellow + "Not every task completed on every device, resume with: " + Console.text_color.reset + f"--resume {checkpoint.run_id}")
+
+async def execute_book(args: argparse.Namespace,
+                       session: meshctrl.Session,
+                       inventory: Inventory,
+                       history: History,
+                       meshbook_file: str,
+                       meshbook: dict,
+                       compiled_device_list: dict,
+                       history_name: str | None,
+                       indent: int | None,
+                       spill: OutputSpill | None,
+                       checkpoint: Checkpoint | None) -> None:
+    '''
+    Execute a meshbook on its resolved targets, streaming or in memory, and write its history.
+    '''
+
+    import json
+    from modules.executor import Executor
+    from modules.history import OutputSpill
+
+    Console.print_line(args.silent)
+    if args.stream:
+        # Results go to disk (and the terminal) one by one, nothing is kept in memory.
+        if history.store is not None and not args.nohistory:
+            stream = history.store.open_run(meshbook_file, meshbook["tasks"], history.open_stream(meshbook_file, meshbook["tasks"], False, indent))
+        else:
+            stream = history.open_stream(meshbook_file, meshbook["tasks"], not args.nohistory, indent, history_name)
+        manifest_entry = None
+        if history.store is None and not args.nohistory: # Registered right away, an interrupted stream is still covered by the retention.
+            spill = OutputSpill(stream.stitched_file.removesuffix(".ndjson") + "_output") # Named after the file that was created, so it is not shared with another run.
+            manifest_entry = history.register(stream.stitched_file, spill.requested_directory)
+        try:
+            with Profiler.span("execute_meshbook", meshbook=meshbook_file, stream=True):
+                await Executor.execute_meshbook(args.silent,
+                                                args.shlex,
+                                                session,
+                                                compiled_device_list,
+                                                meshbook,
+                                                inventory,
+                                                stream,
+                                                spill,
+                                                checkpoint)
+        finally:
+            stream.close()
+        Console.print_line(args.silent)
+
+        if args.nohistory:
+            Console.print_text(args.silent, "Not writing to file.")
+        elif history.store is not None:
+            history.store.set_spill_directory(stream.run_id, spill.spill_directory)
+            Console.print_text(args.silent, f"Streamed {stream.record_count} records to: {history.store.database_file} (run {stream.run_id}).")
+        else:
+            history.update_entry(manifest_entry, spill.spill_directory)
+            Console.print_text(args.silent, f"Streamed {stream.record_count} records to: {stream.stitched_file}.")
+        return
+
+    with Profiler.span("execute_meshbook", meshbook=meshbook_file, stream=False):
+        complete_log = await Executor.execute_meshbook(args.silent,
+                                                    args.shlex,
+                                                    session,
+                                                    compiled_device_list,
+                                                    meshbook,
+                                                    inventory,
+                                                    spill=spill,
+                                                    checkpoint=checkpoint)
+    Console.print_line(args.silent)
+
+    formatted_history = json.dumps(complete_log,indent=indent)
+
+    Console.print_text(args.silent, formatted_history, 9)
+
+    # Pass the output of the whole program to the history class
+    if args.nohistory:
+        Console.print_text(args.silent, "Not writing to file.")
+    elif history.store is not None:
+        with Profiler.span("write_history", meshbook=meshbook_file, backend="sqlite"):
+            run_id = history.store.write_log(meshbook_file, complete_log)
+            history.store.set_spill_directory(run_id, spill.spill_directory)
+        Console.print_text(args.silent, f"Stored as run {run_id} in: {history.store.database_file}.")
+    else:
+        Console.print_text(args.silent, "Writing to file...")
+        with Profiler.span("write_history", meshbook=meshbook_file):
+            history.write_history(formatted_history, history_name, spill.spill_directory)
+
+async def serve(args: argparse.Namespace, os_matcher: OsMatcher) -> None:
+    '''
+    Daemon mode, log in once, keep the inventory warm and run the jobs that come in until interrupted.
+    '''
+
+    from modules.federation import Federation
+    from modules.history import History
+    from modules.inventory import InventoryCache
+    from modules.server import MeshbookServer
+    from modules.utilities import Transform, Utilities
+
+    if not args.socket and not args.listen:
+        Console.print_text(args.silent,
+                           Console.text_color.red + "Serve needs --socket and/or --listen.")
+        return
+
+    if args.listen and not args.token_file: # Every local user can reach the port.
+        Console.print_text(args.silent,
+                           Console.text_color.red + "Serve with --listen needs --token-file.")
+        return
+
+    token = None
+    if args.token_file:
+        with open(args.token_file, "r") as file:
+            token = file.read().strip()
+        if not token:
+            Console.print_text(args.silent,
+                               Console.text_color.red + f"The token file {args.token_file} is empty.")
+            return
+
+    servers = await Utilities.load_servers(args)
+    session = await init_servers(servers)
+    try:
+        inventory_cache = InventoryCache(args.silent, args.cachedir, Utilities.servers_hostname(servers), args.inventory_ttl)
+        inventory = await Utilities.load_inventory(args.silent,
+                                                   session,
+                                                   [],
+                                                   inventory_cache,
+                                                   args.refresh_inventory,
+                                                   args.inventory_state)
+        if isinstance(session, Federation):
+            session.use_inventory(inventory)
+        Console.print_text(args.silent, f"Inventory loaded, {len(inventory)} devices.")
+
+        history = History(args.silent,
+                          args.historydir,
+                          args.flushhistory,
+                          args.history_backend,
+                          args.history_max_age,
+                          args.history_max_count,
+                          int(args.history_max_mb * 1024 * 1024),
+                          args.history_compress_after)
+        try:
+            await MeshbookServer(args, session, inventory, os_matcher, history, token).serve()
+        finally:
+            history.close()
+    finally:
+        await session.close()
+        Transform.close_shlex_pool()
+
 async def main():
-    just_fix_windows_console()
+    if os.name == "nt":
+        from colorama import just_fix_windows_console
+        just_fix_windows_console()
     '''
     Main function where the program starts. Place from which all comands originate (eventually).
     '''
@@ -79,104 +453,153 @@ async def main():
                            Console.text_color.reset + "MeshBook Version: " + Console.text_color.yellow + str(meshbook_version))
         return
 
+    import json
+    import sqlite3
+    from modules.checkpoint import Checkpoint
+    from modules.executor import Executor
+    from modules.history import History
+    from modules.inventory import InventoryCache
+    from modules.os_matcher import OsMatcher
+    from modules.selector import Selector
+    from modules.utilities import Transform, Utilities
+
+    if args.rebuild:
+        indent = None
+        if args.indent: indent = 4
+
+        Console.print_text(args.silent, json.dumps(History.rebuild_log(args.rebuild), indent=indent), 9)
+        return
+
     if not args.oscategories:
         local_categories_file = "./os_categories.json"
     else:
         local_categories_file = args.oscategories
 
+    if args.action == ["serve"]:
+        try:
+            with open(local_categories_file, "r") as file:
+                os_matcher = OsMatcher(json.load(file))
+            await serve(args, os_matcher)
+        except OSError as message:
+            Console.print_text(args.silent, Console.text_color.red + f'{message}')
+        return
+
+    if args.action == ["history", "query"]:
+        try:
+            history = History(True, args.historydir, False, "sqlite")
+            try:
+                results = history.store.query(args.device, args.task, args.meshbook or "", args.since, args.status, args.limit)
+            finally:
+                history.close()
+        except (OSError, ValueError, sqlite3.Error) as message:
+            Console.print_text(args.silent, Console.text_color.red + f'{message}')
+            return
+
+        indent = None
+        if args.indent: indent = 4
+        Console.print_text(args.silent, json.dumps(results, indent=indent), 9)
+        return
+
+    if len(args.action) > 0:
+        parser.print_help()
+        return
+
+    if args.resume:
+        if args.nohistory:
+            Console.print_text(args.silent, Console.text_color.red + "A run can not be resumed with --nohistory, the checkpoint is kept with the history.")
+            return
+        try: # The meshbook and target overrides are taken from the checkpoint, unless given again.
+            resumed_run = Checkpoint.read_run(f"{args.historydir}/checkpoints", args.resume)
+        except (OSError, ValueError) as message:
+            Console.print_text(args.silent, Console.text_color.red + f"Unable to resume run {args.resume}: {message}")
+            return
+        if not args.meshbook:
+            args.meshbook = resumed_run["meshbook"]
+        if not args.group and not args.device:
+            args.group = resumed_run.get("group", "")
+            args.device = resumed_run.get("device", "")
+
     if not args.meshbook:
         parser.print_help()
         return
 
+    if args.profile:
+        Profiler.enable()
+
+    if args.metrics_textfile or args.metrics_push:
+        Metrics.enable()
+
+    session = None
+    history = None
     try:
-        with open(local_categories_file, "r") as file:
-            os_categories = json.load(file)
+        with Profiler.span("load_os_categories"), open(local_categories_file, "r") as file:
+            os_matcher = OsMatcher(json.load(file))
 
-        if not Utilities.path_exist(args.meshbook) or Utilities.path_type(args.meshbook) != "File":
+        meshbook_files = Utilities.resolve_meshbooks(args.meshbook)
+        if len(meshbook_files) == 0:
             Console.print_text(args.silent,
-                               Console.text_color.red + "The given meshbook path is either not present on the filesystem or not a file.")
+                               Console.text_color.red + "The given meshbook path is either not present on the filesystem or does not point to any meshbook.")
+            return
+        if args.resume and len(meshbook_files) > 1:
+            Console.print_text(args.silent,
+                               Console.text_color.red + "--resume continues a single meshbook, not a batch.")
             return
 
-        credentials, meshbook = await asyncio.gather(
-            (Utilities.load_config(args)),
-            (Utilities.compile_book(args.meshbook))
-        )
-
-        if args.group != "":
-            meshbook["group"] = args.group
-            if "device" in meshbook:
-                del meshbook["device"]
-            if "devices" in meshbook:
-                del meshbook["devices"]
-        elif args.device != "":
-            meshbook["device"] = args.device
-            if "group" in meshbook:
-                del meshbook["group"]
-            if "groups" in meshbook:
-                del meshbook["groups"]
+        with Profiler.span("load_config_and_meshbooks", meshbooks=len(meshbook_files)):
+            servers, *meshbooks = await asyncio.gather(
+                (Utilities.load_servers(args)),
+                *(Utilities.compile_book(meshbook_file) for meshbook_file in meshbook_files)
+            )
 
         '''
         The following section mainly displays used variables and first steps of the program to the Console.
         '''
 
-        # INIT ARGUMENTS PRINTING
-        Console.print_line(args.silent)
-        Console.print_text(args.silent,
-                           "meshbook: " + Console.text_color.yellow + args.meshbook + Console.text_color.reset + ".")
-        Console.print_text(args.silent,
-                           "Operating System Categorisation file: " + Console.text_color.yellow + args.oscategories + Console.text_color.reset + ".")
-        Console.print_text(args.silent,
-                           "Configuration file: " + Console.text_color.yellow + args.conf + Console.text_color.reset + ".")
-
-        # TARGET OS PRINTING
-        if "target_os" in meshbook:
-            Console.print_text(args.silent,
-                               "Target Operating System category given: " + Console.text_color.yellow + meshbook["target_os"] + Console.text_color.reset + ".")
-        else:
-            Console.print_text(args.silent,
-                               "Target Operating System category given: " + Console.text_color.yellow + "All" + Console.text_color.reset + ".")
+        invalid_books = set()
+        for meshbook_file, meshbook in zip(meshbook_files, meshbooks):
+            try:
+                Executor.task_dependencies(meshbook["tasks"]) # Catch unknown task ids and cycles before logging in.
+                Executor.check_amounts(meshbook)
+                for task in meshbook["tasks"]:
+                    Executor.retry_conditions(meshbook, task)
+                if "targets" in meshbook:
+                    Selector(meshbook["targets"]) # Catch syntax errors in the targets expression before logging in.
+            except ValueError as message:
+                Console.print_text(args.silent,
+                                   Console.text_color.red + f"{meshbook_file}: {message}")
+                invalid_books.add(meshbook_file)
+                continue
 
-        # Should Meshbook ignore categorisation?
-        if "ignore_categorisation" in meshbook:
-            Console.print_text(args.silent,
-                                "Ignore the OS Categorisation file: " + Console.text_color.yellow + str(meshbook["ignore_categorisation"]) + Console.text_color.reset + ".")
-            if meshbook["ignore_categorisation"]:
+            unknown_placeholders = Transform.unknown_placeholders(meshbook)
+            if unknown_placeholders:
                 Console.print_text(args.silent,
-                                Console.text_color.red + "!!!!\n" +
-                                Console.text_color.yellow + 
-                                "Ignore categorisation is True.\nThis means that the program checks if the target Operating System is somewhere in the reported device Operating System." + 
-                                Console.text_color.red + "\n!!!!")
-        else:
-            Console.print_text(args.silent,
-                                "Ignore the OS Categorisation file: " + Console.text_color.yellow + "False" + Console.text_color.reset + ".")
+                                   Console.text_color.yellow + f"{meshbook_file}: unknown placeholder(s) {', '.join(sorted(unknown_placeholders))}, sent to the devices as written.")
 
-        # TARGET TAG PRINTING
-        if "target_tag" in meshbook:
-            Console.print_text(args.silent,
-                               "Target Device tag given: " + Console.text_color.yellow + meshbook["target_tag"] + Console.text_color.reset + ".")
-        else:
-            Console.print_text(args.silent,
-                               "Target Device tag given: " + Console.text_color.yellow + "All" + Console.text_color.reset + ".")
+            Utilities.apply_target_override(meshbook, args.group, args.device)
+            print_book_info(args, meshbook_file, meshbook)
 
-        # TARGET PRINTING
-        if "device" in meshbook:
-            Console.print_text(args.silent,
-                               "Target device: " + Console.text_color.yellow + str(meshbook["device"]) + Console.text_color.reset + ".")
-        elif "devices" in meshbook:
-            Console.print_text(args.silent,
-                               "Target devices: " + Console.text_color.yellow + str(meshbook["devices"]) + Console.text_color.reset + ".")
-        elif "group" in meshbook:
-            Console.print_text(args.silent,
-                               "Target group: " + Console.text_color.yellow + str(meshbook["group"]) + Console.text_color.reset + ".")
-        elif "groups" in meshbook:
-            Console.print_text(args.silent,
-                               "Target groups: " + Console.text_color.yellow + str(meshbook["groups"]) + Console.text_color.reset + ".")
+        # A meshbook that does not pass the checks is left out, the rest of a batch still runs.
+        batch = len(meshbook_files) > 1
+        meshbooks = [meshbook for meshbook_file, meshbook in zip(meshbook_files, meshbooks) if meshbook_file not in invalid_books]
+        meshbook_files = [meshbook_file for meshbook_file in meshbook_files if meshbook_file not in invalid_books]
+        if len(meshbook_files) == 0:
+            return
 
         # RUNNING PARAMETERS PRINTING
+        Console.print_line(args.silent)
+        if batch:
+            Console.print_text(args.silent, "Meshbooks in batch: " + Console.text_color.yellow + str(len(meshbook_files)) + Console.text_color.reset + ".")
+            Console.print_text(args.silent, "Parallel meshbooks: " + Console.text_color.yellow + str(args.parallel) + Console.text_color.reset + ".")
+        if len(servers) > 1:
+            Console.print_text(args.silent, "MeshCentral servers: " + Console.text_color.yellow + ", ".join(servers) + Console.text_color.reset + ".")
         Console.print_text(args.silent, "Grace: " + Console.text_color.yellow + str(not args.nograce) + Console.text_color.reset + ".") # Negation of bool for correct explanation
         Console.print_text(args.silent, "Silent: " + Console.text_color.yellow + "False" + Console.text_color.reset + ".") # Can be pre-defined because if silent flag was passed then none of this would be printed.
 
-        session = await init_connection(credentials)
+        login_start = time.perf_counter()
+        with Profiler.span("login"):
+            session = await init_servers(servers)
+        Metrics.set("meshbook_login_duration_seconds", time.perf_counter() - login_start)
+        from modules.federation import Federation # Logged in, libmeshctrl is loaded by now.
 
         # PROCESS PRINTING aka what its doing in the moment...
         Console.print_line(args.silent)
@@ -195,76 +618,60 @@ async def main():
         End of the main information displaying section.
         '''
 
-        group_list = await Transform.compile_group_list(session)
-        compiled_device_list = await Utilities.gather_targets(args.silent, meshbook, group_list, os_categories)
-
-        # Check if we have reachable targets on the MeshCentral host
-        if "target_list" not in compiled_device_list or len(compiled_device_list["target_list"]) == 0:
-            Console.print_text(args.silent,
-                               Console.text_color.red + "No targets found or targets unreachable, quitting.")
-
-            Console.print_line(args.silent)
-            return
-
-        Console.print_line(args.silent)
-
-        match meshbook:
-            case {"group": candidate_target_name}:
-                target_name = candidate_target_name
-
-            case {"groups": candidate_target_name}:
-                target_name = str(candidate_target_name)
-
-            case {"device": candidate_target_name}:
-                target_name = candidate_target_name
-
-            case {"devices": candidate_target_name}:
-                target_name = str(candidate_target_name)
-
-            case _:
-                target_name = ""
+        inventory_cache = InventoryCache(args.silent, args.cachedir, Utilities.servers_hostname(servers), args.inventory_ttl)
+        with Profiler.span("load_inventory"):
+            inventory = await Utilities.load_inventory(args.silent,
+                                                       session,
+                                                       meshbooks,
+                                                       inventory_cache,
+                                                       args.refresh_inventory,
+                                                       args.inventory_state,
+                                                       os_matcher)
+        if isinstance(session, Federation): # A cached inventory was not listed through the federation.
+            session.use_inventory(inventory)
+        Metrics.set("meshbook_inventory_devices", len(inventory))
 
         # Initialize the history / logging functions class (whatever you want to name it)
-        history = History(args.silent, args.historydir, args.flushhistory)
+        history = History(args.silent,
+                          args.historydir,
+                          args.flushhistory,
+                          args.history_backend,
+                          args.history_max_age,
+                          args.history_max_count,
+                          int(args.history_max_mb * 1024 * 1024),
+                          args.history_compress_after)
+        Checkpoint.prune(f"{args.historydir}/checkpoints", args.history_max_age, args.history_max_count, args.resume)
 
         # Conclude history initlialization
         Console.print_line(args.silent)
 
-        # From here on the actual exection happens
-        Console.print_text(args.silent,
-                            Console.text_color.yellow + "Executing meshbook on the target(s): " + Console.text_color.green + target_name + Console.text_color.yellow + ".")
-
-        if not args.nograce:
-            Console.print_text(args.silent,
-                                Console.text_color.yellow + "Initiating grace-period...")
-
-            for x in range(grace_period):
+        if not batch:
+            try:
+                await run_book(args, session, inventory, os_matcher, history, meshbook_files[0], meshbooks[0])
+            except ExceptionGroup as error: # Tasks run in a TaskGroup, a failing run_command arrives wrapped in a group.
                 Console.print_text(args.silent,
-                                    Console.text_color.yellow + "{}...".format(x+1)) # Countdown!
-                await asyncio.sleep(1)
-
-        Console.print_line(args.silent)
-        complete_log = await Executor.execute_meshbook(args.silent,
-                                                    args.shlex,
-                                                    session,
-                                                    compiled_device_list,
-                                                    meshbook,
-                                                    group_list)
-        Console.print_line(args.silent)
-
-        indent = None
-        if args.indent: indent = 4
+                                   Console.text_color.red + f"{meshbook_files[0]} failed: {Utilities.describe_error(error)}")
+            return
 
-        formatted_history = json.dumps(complete_log,indent=indent)
+        # Batch: one grace period for all meshbooks, every meshbook gets its own history file.
+        await grace(args)
+        book_slots = asyncio.Semaphore(max(1, args.parallel))
 
-        Console.print_text(args.silent, formatted_history, 9)
+        async def run_batch_book(meshbook_file: str, meshbook: dict) -> None:
+            async with book_slots:
+                await run_book(args, session, inventory, os_matcher, history, meshbook_file, meshbook,
+                               Utilities.history_name(meshbook_file), False)
 
-        # Pass the output of the whole program to the history class
-        if args.nohistory:
-            Console.print_text(args.silent, "Not writing to file.")
-        else:
-            Console.print_text(args.silent, "Writing to file...")
-            history.write_history(formatted_history)
+        # A meshbook that fails while running is reported on its own as well.
+        outcomes = await asyncio.gather(*(run_batch_book(meshbook_file, meshbook) for meshbook_file, meshbook in zip(meshbook_files, meshbooks)),
+                                        return_exceptions=True)
+        failed_books = [(meshbook_file, outcome) for meshbook_file, outcome in zip(meshbook_files, outcomes) if isinstance(outcome, Exception)]
+        for meshbook_file, outcome in failed_books:
+            Console.print_text(args.silent,
+                               Console.text_color.red + f"{meshbook_file} failed: {Utilities.describe_error(outcome)}")
+        if len(failed_books) > 0:
+            Console.print_text(args.silent,
+                               Console.text_color.red + f"{len(failed_books)} of {len(meshbook_files)} meshbooks failed while running.")
 
     except OSError as message:
         Console.print_text(
@@ -280,7 +687,24 @@ async def main():
         raise
 
     finally:
-        await session.close()
+        if session is not None:
+            await session.close()
+        if history is not None:
+            history.close()
+        Transform.close_shlex_pool()
+
+        if Profiler.enabled:
+            profile_files = Profiler.write(args.profile)
+            Console.print_text(args.silent, "Profile written to: " + Console.text_color.yellow + ", ".join(profile_files) + Console.text_color.reset + ".")
+
+        if Metrics.enabled:
+            try:
+                if args.metrics_textfile:
+                    Metrics.write_textfile(args.metrics_textfile)
+                if args.metrics_push:
+                    await asyncio.to_thread(Metrics.push, args.metrics_push)
+            except OSError as message: # urllib errors are OSErrors as well.
+                Console.print_text(args.silent, Console.text_color.red + f"Unable to export the metrics: {message}")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,120 @@
+# Public Python libraries
+from datetime import datetime
+import json
+import os
+import time
+
+# Local Python libraries/modules
+from modules.console import Console
+from modules.history import History
+
+class Checkpoint():
+    def __init__(self, silent: bool, checkpoint_directory: str, run_id: str | None, meshbook_file: str, group: str = "", device: str = "") -> None:
+        '''
+        Progress of a run per task and device, appended to <checkpoint_directory>/<run id>.ndjson as every response arrives.
+        Without a run id a new checkpoint is started, with the run id of an earlier run that checkpoint is resumed:
+        the (task, device) pairs that completed are replayed into the log instead of being dispatched again.
+        '''
+        self.silent = silent
+        self.replay = {} # (task index, device id) -> record of a pair completed in an earlier attempt.
+        self.done = set() # Every completed (task index, device id) pair, earlier attempts included.
+        self.finished = False # Set by the Executor once every task completed on every target.
+
+        os.makedirs(checkpoint_directory, exist_ok=True)
+
+        if run_id is None:
+            self.checkpoint_file, self.file = History.open_unique(f"{checkpoint_directory}/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.splitext(os.path.basename(meshbook_file))[0]}.ndjson",
+                                                                  buffering=1)
+            self.run_id = os.path.splitext(os.path.basename(self.checkpoint_file))[0]
+            self.write_record({"record": "run", "meshbook": meshbook_file, "group": group, "device": device})
+        else:
+            self.run_id = run_id
+            self.checkpoint_file = f"{checkpoint_directory}/{run_id}.ndjson"
+            self.load()
+            self.file = open(self.checkpoint_file, "a", buffering=1)
+
+    @staticmethod
+    def read_run(checkpoint_directory: str, run_id: str) -> dict:
+        '''
+        The meshbook and target overrides a checkpoint was started with, so --resume does not need them again.
+        '''
+
+        with open(f"{checkpoint_directory}/{run_id}.ndjson", "r") as f:
+            return json.loads(f.readline())
+
+    @staticmethod
+    def prune(checkpoint_directory: str, max_age_days: float = 0, max_count: int = 0, keep: str | None = None) -> None:
+        '''
+        Remove the checkpoints older than max_age_days, and all but the newest max_count (0 disables a limit).
+        Every run that did not complete on every device leaves its checkpoint behind, the run that is being resumed (keep) stays.
+        '''
+
+        if not (max_age_days or max_count) or not os.path.isdir(checkpoint_directory):
+            return
+
+        checkpoints = sorted((item for item in os.scandir(checkpoint_directory) if item.is_file() and item.name.endswith(".ndjson")),
+                             key=lambda item: item.stat().st_mtime, reverse=True)
+        now = time.time()
+        for position, item in enumerate(checkpoints): # Newest first.
+            if os.path.splitext(item.name)[0] == keep:
+                continue
+            if (max_count and position >= max_count) or (max_age_days and now - item.stat().st_mtime > max_age_days * 86400):
+                os.remove(item.path)
+
+    def load(self) -> None:
+        with open(self.checkpoint_file, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError: # The last line of an interrupted run can be cut off.
+                    continue
+
+                match record.get("record"):
+                    case "result" if record["response"].get("complete", False):
+                        self.replay[(record["task"], record["response"]["device_id"])] = record
+                    case "duplicate" if record["complete"]:
+                        self.replay[(record["task"], record["device_id"])] = record
+        self.done = set(self.replay)
+
+        Console.print_text(self.silent,
+                           "Resuming run: " + Console.text_color.yellow + self.run_id + Console.text_color.reset + f", {len(self.replay)} completed task(s) on devices are not dispatched again.")
+
+    def completed(self, index: int, device: str) -> bool:
+        return (index, device) in self.done
+
+    def replay_records(self) -> list[dict]:
+        '''
+        Completed pairs of the earlier attempts, the first device of an aggregated output before the devices that share it.
+        '''
+
+        return sorted(self.replay.values(), key=lambda record: record["record"] != "result")
+
+    def write_record(self, record: dict) -> None:
+        self.file.write(json.dumps(record) + "\n")
+
+    def add_result(self, index: int, device_response: dict) -> None:
+        '''
+        Only a completed response is replayed on a resume, the output of a failed one is not kept.
+        '''
+
+        if not device_response.get("complete", False):
+            self.write_record({"record": "result", "task": index, "response": {"device_id": device_response["device_id"], "complete": False}})
+            return
+        self.write_record({"record": "result", "task": index, "response": device_response})
+        self.done.add((index, device_response["device_id"]))
+
+    def add_duplicate(self, index: int, output_hash: str, device_id: str, device_name: str, complete: bool) -> None:
+        self.write_record({"record": "duplicate", "task": index, "output_hash": output_hash, "device_id": device_id, "device_name": device_name, "complete": complete})
+        if complete:
+            self.done.add((index, device_id))
+
+    def close(self) -> None:
+        '''
+        A finished run (every task completed on every target) has nothing left to resume, so its checkpoint is removed.
+        '''
+
+        self.file.close()
+        if self.finished:
+            os.remove(self.checkpoint_file)
@@ -1,55 +1,708 @@
 # Public Python libraries
+from __future__ import annotations
 import argparse
+import asyncio
+from contextlib import nullcontext
+import hashlib
 import json
-import meshctrl
-from time import sleep
+import math
+import re
+import time
+from typing import TYPE_CHECKING
 
 # Local Python libraries/modules
+from modules.checkpoint import Checkpoint
 from modules.console import Console
-from modules.utilities import Transform
+from modules.history import OutputSpill
+from modules.inventory import Inventory
+from modules.metrics import Metrics
+from modules.profiler import Profiler
+from modules.utilities import Template, Transform, Utilities
 
-intertask_delay = 1
+if TYPE_CHECKING: # The session is only annotated here, importing libmeshctrl is left to the code that connects.
+    import meshctrl
+
+intertask_delay = 1 # Default delay between two tasks in seconds, a meshbook can override it with "task_delay".
+command_timeout = 1800 # Default seconds a device gets to answer a task, a meshbook or task can override it with "timeout".
+default_retry_delay = 1 # Default seconds before the first retry of a device, doubled for every next retry.
+dispatch_batch_size = 100 # Most devices per run_command when a timeout or quorum splits a task up, the batches all go out at once.
+dispatch_batches = 50 # Smaller fleets are split into this many batches, so a quorum like 98% is reached past a single hung device.
+
+class ResultLog:
+    def __init__(self, tasks: list[dict]) -> None:
+        '''
+        In-memory result sink, collects every device response and builds the complete_log layout at the end.
+        '''
+        self.tasks = tasks
+        self.task_results = [[] for _ in tasks]
+        self.duplicates = {}
+        self.sections = {}
+
+    def add_result(self, index: int, device_response: dict) -> None:
+        self.task_results[index].append(device_response)
+
+    def add_duplicate(self, index: int, output_hash: str, device_id: str, device_name: str) -> None:
+        self.duplicates.setdefault((index, output_hash), []).append({"device_id": device_id, "device_name": device_name})
+
+    def add_section(self, name: str, device_names: list[str]) -> None:
+        self.sections[name] = device_names
+
+    def to_dict(self, targets: list[str]) -> dict:
+        '''
+        Order every task's data like the target list, no matter in which order the responses arrived.
+        An aggregated output lists the devices that returned it under "devices", instead of a single device_id and device_name.
+        '''
+
+        position = {device: index for index, device in enumerate(targets)}
+
+        complete_log = {}
+        for index, task in enumerate(self.tasks):
+            data = sorted(self.task_results[index], key=lambda response: position.get(response["device_id"], len(position)))
+
+            for response in data:
+                if "output_hash" in response:
+                    devices = [{"device_id": response.pop("device_id"), "device_name": response.pop("device_name")}]
+                    devices.extend(self.duplicates.get((index, response["output_hash"]), []))
+                    response["devices"] = sorted(devices, key=lambda device: position.get(device["device_id"], len(position)))
+
+            complete_log["task_" + str(index + 1)] = {
+                "task_name": task["name"],
+                "data": data
+            }
+        complete_log.update(self.sections)
+        return complete_log
 
 class Executor:
     @staticmethod
-    async def execute_meshbook(silent: bool, enable_shlex: bool, session: meshctrl.Session, compiled_device_list: dict, meshbook: dict, group_list: dict) -> dict:
+    async def execute_meshbook(silent: bool, enable_shlex: bool, session: meshctrl.Session, compiled_device_list: dict, meshbook: dict, inventory: Inventory, sink=None, spill: OutputSpill | None = None, checkpoint: Checkpoint | None = None) -> dict | None:
         '''
         Actual function that handles meshbook execution, also responsible for formatting the resulting JSON.
+
+        Every response is processed as soon as it arrives.
+        Without a sink every response is kept in memory and the complete log is returned.
+        With a sink (like HistoryStream) every response is handed over right away, nothing is kept and None is returned.
+        Outputs above max_output_bytes are truncated, with a spill the full output is kept in a side file.
+        With a checkpoint every response is recorded for --resume, and the pairs it already completed are replayed instead of dispatched.
         '''
 
-        complete_log = {}
         targets = compiled_device_list["target_list"]
         offline = compiled_device_list["offline_list"]
-        round = 1
+        tasks = meshbook["tasks"]
+        task_delay = meshbook.get("task_delay", intertask_delay)
+        max_fail_percentage = meshbook.get("max_fail_percentage")
 
-        for task in meshbook["tasks"]:
-            Console.print_text(silent,
-                               Console.text_color.green + str(round) + ". Running: " + task["name"])
+        streaming = sink is not None
+        if not streaming:
+            sink = ResultLog(tasks)
+
+        match meshbook.get("strategy", "linear"):
+            case "pipelined":
+                strategy = Executor.run_pipelined
+            case "linear":
+                strategy = Executor.run_linear
+            case unknown_strategy:
+                Console.print_text(silent,
+                                   Console.text_color.yellow + f"Unknown strategy '{unknown_strategy}', falling back to linear.")
+                strategy = Executor.run_linear
+
+        waves = Executor.plan_waves(targets, meshbook)
+        wave_answers = {}
+        wave_failed = set()
+        dispatched = 0
+        failed = 0
+        distinct_outputs = [{} for _ in tasks] # Per task, output hash -> set once the first device with that output is recorded.
+        for task in tasks: # A bad retry_on stops the run before anything is dispatched.
+            Executor.retry_conditions(meshbook, task)
+        templates = [Template.compile(task["command"]) for task in tasks]
+        facts = {} # Device id -> placeholder values, only filled when a command has device placeholders.
+        resumed_answers = {}
+        completed = None
 
-            if "powershell" in meshbook and meshbook["powershell"]:
-                response = await session.run_command(nodeids=targets, command=task["command"],powershell=True,ignore_output=False,timeout=1800)
+        if checkpoint is not None:
+            completed = checkpoint.completed
+            for replayed in checkpoint.replay_records():
+                index = replayed["task"]
+                if replayed["record"] == "result":
+                    device_response = replayed["response"]
+                    if "output_hash" in device_response:
+                        distinct_outputs[index][device_response["output_hash"]] = asyncio.Event()
+                        distinct_outputs[index][device_response["output_hash"]].set()
+                    sink.add_result(index, device_response)
+                    device = device_response["device_id"]
+                else:
+                    sink.add_duplicate(index, replayed["output_hash"], replayed["device_id"], replayed["device_name"])
+                    device = replayed["device_id"]
+                resumed_answers[device] = resumed_answers.get(device, 0) + 1
+
+        def command_of(index: int, device: str) -> str:
+            if not templates[index].fields:
+                return tasks[index]["command"]
+            if device not in facts:
+                facts[device] = Transform.device_facts(device, inventory)
+            shell = Transform.device_shell(facts[device]["device_os"], bool(meshbook.get("powershell", False)))
+            return templates[index].render(facts[device], lambda value: Transform.quote_fact(value, shell))
+
+        async def record(index: int, device: str, device_response: dict) -> None:
+            max_output_bytes = tasks[index].get("max_output_bytes", meshbook.get("max_output_bytes"))
+            full_output = None
+            if max_output_bytes is not None:
+                full_output = Executor.cap_output(device_response, int(max_output_bytes))
+            device_response = await Executor.format_response(device, device_response, inventory)
+
+            wave_answers[device] = wave_answers.get(device, 0) + 1
+            if device_response.get("timed_out", False):
+                wave_failed.add(device)
+                Metrics.count("meshbook_devices", meshbook=meshbook.get("name", ""), status="timed_out")
+            elif not device_response.get("complete", False):
+                wave_failed.add(device)
+                Metrics.count("meshbook_devices", meshbook=meshbook.get("name", ""), status="failed")
             else:
-                response = await session.run_command(nodeids=targets, command=task["command"],powershell=False,ignore_output=False,timeout=1800)
+                Metrics.count("meshbook_devices", meshbook=meshbook.get("name", ""), status="succeeded")
 
-            task_batch = []
-            for device in response:
-                device_result = response[device]["result"]
-                response[device]["result"] = device_result.replace("Run commands completed.", "")
-                response[device]["device_id"] = device
-                response[device]["device_name"] = await Transform.translate_nodeid_to_name(device, group_list)
-                task_batch.append(response[device])
+            aggregate = tasks[index].get("aggregate", meshbook.get("aggregate", False))
+            if aggregate:
+                output_hash = Executor.output_hash(device_response)
+                if output_hash in distinct_outputs[index]: # Seen before, only the device is added to that output.
+                    await distinct_outputs[index][output_hash].wait()
+                    sink.add_duplicate(index, output_hash, device_response["device_id"], device_response["device_name"])
+                    if checkpoint is not None:
+                        checkpoint.add_duplicate(index, output_hash, device_response["device_id"], device_response["device_name"], device_response.get("complete", False))
+                    return
 
-            complete_log["task_" + str(round)] = {
-                "task_name": task["name"],
-                "data": task_batch
-            }
-            round += 1
-            sleep(intertask_delay) # Sleep for x amount of time.
+                distinct_outputs[index][output_hash] = asyncio.Event()
+                device_response["output_hash"] = output_hash
+
+            if full_output is not None and spill is not None: # Only a kept output is spilled, compressing megabytes takes a while so keep it off the event loop.
+                device_response.update(await asyncio.to_thread(spill.write, index + 1, device, full_output))
+            await Transform.process_device_response_offloaded(enable_shlex, device_response)
+            sink.add_result(index, device_response)
+            if checkpoint is not None:
+                checkpoint.add_result(index, device_response)
+            if aggregate:
+                distinct_outputs[index][output_hash].set()
+
+        for wave_number, wave in enumerate(waves):
+            if len(waves) > 1:
+                Console.print_text(silent,
+                                   Console.text_color.yellow + f"Wave {wave_number + 1}/{len(waves)}: {len(wave)} device(s).")
+
+            wave_answers.clear()
+            wave_failed.clear()
+            await strategy(silent, session, wave, meshbook, task_delay, record, completed, command_of)
+
+            # A device failed when it did not complete one of the tasks or did not answer at all.
+            wave_failed.update(device for device in wave if wave_answers.get(device, 0) + resumed_answers.get(device, 0) < len(tasks))
+            dispatched += len(wave)
+            failed += len(wave_failed)
+
+            if max_fail_percentage is not None and dispatched > 0 and failed / dispatched * 100 > float(max_fail_percentage):
+                skipped = [device for later_wave in waves[wave_number + 1:] for device in later_wave]
+                Console.print_text(silent,
+                                   Console.text_color.red + f"Failure budget of {max_fail_percentage}% exceeded ({failed}/{dispatched} devices failed), skipping {len(skipped)} device(s).")
+                sink.add_section("Skipped", [await Transform.translate_nodeid_to_name(device, inventory) for device in skipped])
+                Metrics.count("meshbook_devices", len(skipped), meshbook=meshbook.get("name", ""), status="skipped")
+                break
 
         for index, device in enumerate(offline): # Replace Device_id with actual human readable name
-            device_name = await Transform.translate_nodeid_to_name(device, group_list)
+            device_name = await Transform.translate_nodeid_to_name(device, inventory)
             offline[index] = device_name
-        complete_log["Offline"] = offline
+        sink.add_section("Offline", offline)
+        Metrics.count("meshbook_devices", len(offline), meshbook=meshbook.get("name", ""), status="offline")
+
+        if checkpoint is not None:
+            checkpoint.finished = all(checkpoint.completed(index, device) for index in range(len(tasks)) for device in targets)
+
+        if streaming:
+            return None
+
+        # Return the result, every response was already processed when it arrived.
+        return sink.to_dict(targets)
+
+    @staticmethod
+    def plan_waves(targets: list[str], meshbook: dict) -> list[list[str]]:
+        '''
+        Split the targets into the waves they are dispatched in: an optional canary wave ("canary") followed by waves of "serial" devices.
+        Both accept an absolute count or a percentage of the targets, without them all targets form a single wave.
+        '''
+
+        waves = []
+        remaining = targets
+
+        if "canary" in meshbook and len(remaining) > 0:
+            canary_size = Utilities.resolve_amount(meshbook["canary"], len(targets))
+            waves.append(remaining[:canary_size])
+            remaining = remaining[canary_size:]
+
+        if "serial" in meshbook:
+            wave_size = Utilities.resolve_amount(meshbook["serial"], len(targets))
+        else:
+            wave_size = max(1, len(remaining))
+
+        for index in range(0, len(remaining), wave_size):
+            waves.append(remaining[index:index + wave_size])
+
+        if len(waves) == 0:
+            waves.append([])
+        return waves
+
+    @staticmethod
+    def check_amounts(meshbook: dict) -> None:
+        '''
+        Check "canary", "serial" and "quorum" (a count or a percentage) and "max_in_flight" (a count) up front,
+        they are only resolved once the targets are known and a bad value would otherwise stop a run halfway.
+        '''
+
+        amounts = [(key, meshbook[key], "") for key in ("canary", "serial", "quorum") if meshbook.get(key) is not None]
+        amounts += [("quorum", task["quorum"], f"Task '{task['name']}' has an invalid ") for task in meshbook["tasks"] if task.get("quorum") is not None]
+        for key, value, prefix in amounts:
+            try:
+                Utilities.resolve_amount(value, 1)
+            except (TypeError, ValueError):
+                raise ValueError(f"{prefix or 'Invalid '}{key} '{value}', use a count or a percentage like 25%.")
+
+        max_in_flight = meshbook.get("max_in_flight")
+        if max_in_flight is not None and (isinstance(max_in_flight, bool) or not isinstance(max_in_flight, int) or max_in_flight < 1):
+            raise ValueError(f"Invalid max_in_flight '{max_in_flight}', use a count of at least 1.")
+
+    @staticmethod
+    def task_timeout(meshbook: dict, task: dict) -> float:
+        return float(task.get("timeout", meshbook.get("timeout", command_timeout)))
+
+    @staticmethod
+    def timed_out_response(command: str, cut_off: bool = False) -> dict:
+        '''
+        Response of a device that did not answer in time, cut_off marks the devices that were still running when the quorum was reached.
+        '''
+
+        device_response = {"complete": False, "result": "", "command": command, "timed_out": True}
+        if cut_off:
+            device_response["cut_off"] = True
+        return device_response
+
+    @staticmethod
+    def retry_conditions(meshbook: dict, task: dict) -> list:
+        '''
+        Turn "retry_on" (a single condition or a list) into the conditions a device is retried on: "timeout" (no answer in time),
+        "failed" (did not complete), "empty" (no output) or {"pattern": <regex>} (the output matches).
+        Without "retry_on" a device is retried when it timed out or failed.
+        '''
+
+        retry_on = task.get("retry_on", meshbook.get("retry_on", ["timeout", "failed"]))
+        if not isinstance(retry_on, list):
+            retry_on = [retry_on]
+
+        conditions = []
+        for condition in retry_on:
+            if isinstance(condition, dict) and "pattern" in condition:
+                try:
+                    conditions.append(re.compile(str(condition["pattern"])))
+                except re.error as error:
+                    raise ValueError(f"Task '{task['name']}' has an invalid retry_on pattern: {error}.")
+            elif condition in ("timeout", "failed", "empty"):
+                conditions.append(condition)
+            else:
+                raise ValueError(f"Task '{task['name']}' has an unknown retry_on condition '{condition}'.")
+        return conditions
+
+    @staticmethod
+    def should_retry(conditions: list, device_response: dict) -> bool:
+        if device_response.get("cut_off", False): # Cut off on purpose by the quorum, not a device failure.
+            return False
+
+        timed_out = device_response.get("timed_out", False)
+        output = device_response["result"].replace("Run commands completed.", "")
+        for condition in conditions:
+            match condition:
+                case "timeout" if timed_out:
+                    return True
+                case "failed" if not timed_out and not device_response.get("complete", False):
+                    return True
+                case "empty" if not timed_out and not output.strip():
+                    return True
+                case re.Pattern() if condition.search(output):
+                    return True
+        return False
+
+    @staticmethod
+    async def dispatch(session: meshctrl.Session, nodeids: list[str], command: str, meshbook: dict, task: dict, record, cut_off: asyncio.Event | None = None, in_flight=None) -> None:
+        '''
+        Send a task to nodeids in one run_command and hand every final device response to record(device, device_response).
+        The devices whose response matches a retry condition are sent again together, at most "retries" times, the others are recorded right away.
+        The first retry waits retry_delay seconds, every next one twice as long as the one before. A response that needed more than one attempt gets an "attempts" count.
+        Every attempt takes an in_flight slot (when given) and stops waiting once cut_off is set (when given),
+        so retries count against max_in_flight and never keep a task open after its quorum was reached. A device cut off while being retried keeps the response it had.
+        '''
+
+        timeout = Executor.task_timeout(meshbook, task)
+        retries = int(task.get("retries", meshbook.get("retries", 0)))
+        conditions = Executor.retry_conditions(meshbook, task) if retries > 0 else []
+        retry_delay = float(task.get("retry_delay", meshbook.get("retry_delay", default_retry_delay)))
+
+        async def send(devices: list[str]) -> dict:
+            async with in_flight or nullcontext():
+                if cut_off is None:
+                    return await Executor.run_command(session, devices, command, meshbook, timeout)
+                if cut_off.is_set(): # The quorum was reached before these devices got their turn.
+                    return {device: Executor.timed_out_response(command, True) for device in devices}
+                return await Executor.run_until(cut_off, session, devices, command, meshbook, timeout)
+
+        response = await send(nodeids)
+        attempt = 1
+        while True:
+            pending = {device for device in response if attempt <= retries and Executor.should_retry(conditions, response[device])}
+            await asyncio.gather(*(record(device, response[device]) for device in response if device not in pending))
+            if len(pending) == 0:
+                return
+
+            if cut_off is None:
+                await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
+            else: # The quorum can be reached during the backoff.
+                try:
+                    await asyncio.wait_for(cut_off.wait(), retry_delay * 2 ** (attempt - 1))
+                    await asyncio.gather(*(record(device, response[device]) for device in pending))
+                    return
+                except TimeoutError:
+                    pass
+            attempt += 1
+            Metrics.count("meshbook_retries", len(pending), meshbook=meshbook.get("name", ""), task=task["name"])
+
+            retried = await send(list(pending))
+            for device in pending:
+                device_response = retried.get(device, Executor.timed_out_response(command))
+                if not device_response.get("cut_off", False):
+                    device_response["attempts"] = attempt
+                    response[device] = device_response
+            response = {device: response[device] for device in pending}
+
+    @staticmethod
+    def group_by_command(targets: list[str], command_of) -> dict[str, list[str]]:
+        '''
+        Group the targets on their rendered command, so per device placeholders do not turn into a dispatch per device.
+        '''
+
+        groups = {}
+        for device in targets:
+            groups.setdefault(command_of(device), []).append(device)
+        return groups
+
+    @staticmethod
+    def plan_batches(targets: list[str], command_of, batch_size: int) -> list[tuple[str, list[str]]]:
+        '''
+        Split the targets into (command, devices) batches of at most batch_size devices that share their rendered command.
+        '''
+
+        batches = []
+        for command, devices in Executor.group_by_command(targets, command_of).items():
+            for index in range(0, len(devices), batch_size):
+                batches.append((command, devices[index:index + batch_size]))
+        return batches
+
+    @staticmethod
+    async def run_command(session: meshctrl.Session, nodeids: list[str], command: str, meshbook: dict, timeout: float = command_timeout) -> dict:
+        '''
+        Single place where commands are sent to MeshCentral, so every strategy dispatches the same way.
+        When the devices did not answer within timeout seconds, they are all returned as timed out.
+        '''
+
+        powershell = "powershell" in meshbook and meshbook["powershell"]
+        with Profiler.span("run_command", "run_command", command=command, devices=len(nodeids)):
+            start = time.perf_counter_ns()
+            response = None
+            try:
+                async with asyncio.timeout(timeout):
+                    response = await session.run_command(nodeids=nodeids, command=command, powershell=powershell, ignore_output=False, timeout=timeout)
+            except* TimeoutError: # libmeshctrl raises its own timeout from inside a task group.
+                pass
+            if response is None:
+                response = {device: Executor.timed_out_response(command) for device in nodeids}
+
+        # Per device, the time between dispatching and receiving its response. A call for several devices only returns
+        # once the slowest one answered, so that is only known for a device that was dispatched on its own.
+        if (Profiler.enabled or Metrics.enabled) and len(nodeids) == 1:
+            end = time.perf_counter_ns()
+            for device in response:
+                Profiler.record(device, "device", start, end, {"command": command, "complete": response[device].get("complete", False)})
+                Metrics.observe("meshbook_device_response_seconds", (end - start) / 1e9, meshbook=meshbook.get("name", ""))
+        return response
+
+    @staticmethod
+    async def run_until(cut_off: asyncio.Event, session: meshctrl.Session, nodeids: list[str], command: str, meshbook: dict, timeout: float) -> dict:
+        '''
+        run_command that stops waiting once cut_off is set, the devices that did not answer by then are returned as timed out.
+        '''
+
+        command_task = asyncio.ensure_future(Executor.run_command(session, nodeids, command, meshbook, timeout))
+        cut_off_task = asyncio.ensure_future(cut_off.wait())
+        await asyncio.wait({command_task, cut_off_task}, return_when=asyncio.FIRST_COMPLETED)
+        cut_off_task.cancel()
+
+        if not command_task.done():
+            command_task.cancel()
+            await asyncio.wait({command_task})
+            return {device: Executor.timed_out_response(command, True) for device in nodeids}
+        return command_task.result()
+
+    @staticmethod
+    async def run_quorum(silent: bool, session: meshctrl.Session, nodeids: list[str], command_of, meshbook: dict, task: dict, quorum: int | str | None, record) -> None:
+        '''
+        Dispatch the devices in batches of at most dispatch_batch_size (devices with the same command, command_of(device)) that all go out at once,
+        so the answers of a batch are recorded as soon as it finished and a hung device only holds up its own batch.
+        With max_in_flight every device is dispatched on its own and at most max_in_flight of them run at once, the next one starts as soon as one answers.
+        libmeshctrl hands every server event to every running run_command, so that costs max_in_flight times the events of a single call.
+        Once quorum devices (a count or a percentage) answered, the batches that are still running are cut off and recorded as timed out.
+        '''
+
+        needed = len(nodeids)
+        if quorum is not None:
+            needed = min(needed, Utilities.resolve_amount(quorum, len(nodeids)))
+
+        cut_off = asyncio.Event()
+        answered = 0
+        timed_out = 0
+        max_in_flight = meshbook.get("max_in_flight")
+        in_flight = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+        async def count(device: str, device_response: dict) -> None:
+            nonlocal answered, timed_out
+            if device_response.get("timed_out", False):
+                timed_out += 1
+            else:
+                answered += 1
+                if answered >= needed:
+                    cut_off.set()
+            await record(device, device_response)
+
+        batch_size = 1 if max_in_flight else min(dispatch_batch_size, math.ceil(len(nodeids) / dispatch_batches))
+        await asyncio.gather(*(Executor.dispatch(session, batch, command, meshbook, task, count, cut_off, in_flight)
+                               for command, batch in Executor.plan_batches(nodeids, command_of, batch_size)))
+        if timed_out > 0:
+            Console.print_text(silent,
+                               Console.text_color.yellow + f"{timed_out} device(s) did not answer in time and are recorded as timed out.")
+
+    @staticmethod
+    def cap_output(device_response: dict, max_output_bytes: int) -> bytes | None:
+        '''
+        Keep only the head and the tail of an output above max_output_bytes, returns the full output for the spill (None when it fit).
+        The sha256 of the full output is always added, so aggregation never merges outputs that only share their head and tail
+        and only the first device with an output has to spill it.
+        '''
+
+        result = device_response["result"]
+        if len(result) * 4 <= max_output_bytes: # Can not be too large, no need to encode it.
+            return None
+
+        output = result.encode().replace(b"Run commands completed.", b"")
+        if len(output) <= max_output_bytes:
+            return None
+
+        half = max_output_bytes // 2
+        head = output[:half].decode(errors="ignore")
+        tail = output[len(output) - half:].decode(errors="ignore")
+        device_response["result"] = head + f"\n[... {len(output) - 2 * half} bytes truncated ...]\n" + tail
+        device_response["truncated"] = True
+        device_response["output_bytes"] = len(output)
+        device_response["sha256"] = hashlib.sha256(output).hexdigest()
+        return output
+
+    @staticmethod
+    def output_hash(device_response: dict) -> str:
+        '''
+        Devices with the same output (and the same completion state) get the same hash, truncated outputs only when their full outputs match.
+        The command is part of it, with device placeholders only devices that ran the same rendered command share an output.
+        '''
+
+        output = "\n".join((str(device_response.get("complete", False)), device_response.get("command", ""), device_response.get("sha256", ""), device_response["result"]))
+        return hashlib.sha256(output.encode()).hexdigest()
+
+    @staticmethod
+    async def format_response(device: str, device_response: dict, inventory: Inventory) -> dict:
+        '''
+        Strip the MeshCentral completion marker and attach the device id and name to a single device response.
+        '''
+
+        device_response["result"] = device_response["result"].replace("Run commands completed.", "")
+        device_response["device_id"] = device
+        device_response["device_name"] = await Transform.translate_nodeid_to_name(device, inventory)
+        server = inventory.server_of(device)
+        if server: # Only with several servers, names are not unique across them.
+            device_response["server"] = server
+        return device_response
+
+    @staticmethod
+    def task_dependencies(tasks: list[dict]) -> list[set[int]]:
+        '''
+        Turn the optional "id" and "depends_on" task keys into the dependencies (task indexes) of every task.
+        A task without "depends_on" waits for the task before it, so meshbooks without these keys keep running in order.
+        With "depends_on: []" a task starts right away, next to the other independent tasks.
+        '''
+
+        task_ids = {}
+        for index, task in enumerate(tasks):
+            if "id" in task:
+                if str(task["id"]) in task_ids:
+                    raise ValueError(f"Task id '{task['id']}' is used more than once.")
+                task_ids[str(task["id"])] = index
+
+        dependencies = []
+        for index, task in enumerate(tasks):
+            if "depends_on" not in task:
+                dependencies.append({index - 1} if index > 0 else set())
+                continue
+
+            depends_on = task["depends_on"] or []
+            if not isinstance(depends_on, list):
+                depends_on = [depends_on]
+
+            required = set()
+            for task_id in depends_on:
+                if str(task_id) not in task_ids:
+                    raise ValueError(f"Task '{task['name']}' depends on unknown task id '{task_id}'.")
+                required.add(task_ids[str(task_id)])
+            dependencies.append(required)
+
+        remaining = {index: required for index, required in enumerate(dependencies)}
+        while len(remaining) > 0: # Peel off the tasks without open dependencies, whatever is left over forms a cycle.
+            ready = [index for index, required in remaining.items() if not required & remaining.keys()]
+            if len(ready) == 0:
+                raise ValueError("Task dependencies contain a cycle between: " + ", ".join(tasks[index]["name"] for index in remaining) + ".")
+            for index in ready:
+                del remaining[index]
+
+        return dependencies
+
+    @staticmethod
+    async def run_graph(dependencies: list[set[int]], task_delay: float, run_task) -> None:
+        '''
+        Start every task as soon as the tasks it depends on are finished, so independent tasks run concurrently.
+        The task delay is only waited for when other tasks depend on the finished one.
+        '''
+
+        finished = [asyncio.Event() for _ in dependencies]
+        required_tasks = set().union(*dependencies)
+
+        async def task_runner(index: int) -> None:
+            for required in dependencies[index]:
+                await finished[required].wait()
+            await run_task(index)
+            if index in required_tasks:
+                await asyncio.sleep(task_delay) # Sleep for x amount of time.
+            finished[index].set()
+
+        async with asyncio.TaskGroup() as task_group:
+            for index in range(len(dependencies)):
+                task_group.create_task(task_runner(index))
+
+    @staticmethod
+    async def run_linear(silent: bool, session: meshctrl.Session, targets: list[str], meshbook: dict, task_delay: float, record, completed=None, command_of=None) -> None:
+        '''
+        Run every task on all targets at once, a task starts when the slowest device answered the tasks it depends on.
+        completed tells which (task, device) pairs are done already (when resuming), those are not dispatched again.
+        command_of gives the command of a device (with its placeholders filled in), devices with the same command share a run_command call.
+        '''
+
+        if command_of is None:
+            command_of = lambda index, device: meshbook["tasks"][index]["command"]
+
+        tasks = meshbook["tasks"]
+
+        async def run_task(index: int) -> None:
+            task = tasks[index]
+            task_targets = targets
+            if completed is not None:
+                task_targets = [device for device in targets if not completed(index, device)]
+                if len(task_targets) == 0:
+                    Console.print_text(silent,
+                                       Console.text_color.green + str(index + 1) + ". Completed earlier: " + task["name"])
+                    return
+
+            Console.print_text(silent,
+                               Console.text_color.green + str(index + 1) + ". Running: " + task["name"])
+
+            quorum = task.get("quorum", meshbook.get("quorum"))
+
+            task_start = time.perf_counter()
+            with Profiler.span(task["name"], "task", task=index + 1, devices=len(task_targets)):
+                # Cut off stragglers without losing the answers of the batches that finished, with max_in_flight a device that answers frees its slot for the next one.
+                if quorum is not None or "timeout" in task or "timeout" in meshbook or meshbook.get("max_in_flight"):
+                    await Executor.run_quorum(silent, session, task_targets, lambda device: command_of(index, device), meshbook, task, quorum,
+                                              lambda device, device_response: record(index, device, device_response))
+                else:
+                    await asyncio.gather(*(Executor.dispatch(session, devices, command, meshbook, task, lambda device, device_response: record(index, device, device_response))
+                                           for command, devices in Executor.group_by_command(task_targets, lambda device: command_of(index, device)).items()))
+            Metrics.observe("meshbook_task_duration_seconds", time.perf_counter() - task_start, meshbook=meshbook.get("name", ""), task=task["name"])
+
+        await Executor.run_graph(Executor.task_dependencies(tasks), task_delay, run_task)
+
+    @staticmethod
+    async def run_pipelined(silent: bool, session: meshctrl.Session, targets: list[str], meshbook: dict, task_delay: float, record, completed=None, command_of=None) -> None:
+        '''
+        Every device moves through the task graph on its own, so a fast device never waits for a straggler.
+        With a quorum, the devices that are still running once quorum devices finished every task are cut off (timed out).
+        A task with its own quorum cuts off the devices still running that task once quorum devices answered it, they go on with the next task.
+        With max_in_flight at most that many devices run a task at once.
+        '''
+
+        tasks = meshbook["tasks"]
+        dependencies = Executor.task_dependencies(tasks)
+        announced = set()
+        if command_of is None:
+            command_of = lambda index, device: tasks[index]["command"]
+        max_in_flight = meshbook.get("max_in_flight")
+        in_flight = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+        needed = len(targets)
+        if meshbook.get("quorum") is not None:
+            needed = min(needed, Utilities.resolve_amount(meshbook["quorum"], len(targets)))
+        finished = 0
+
+        task_cut_offs = [asyncio.Event() for _ in tasks] # All of them are set once the meshbook quorum is reached.
+        task_needed = []
+        task_answered = [0 for _ in tasks]
+        for index, task in enumerate(tasks):
+            if task.get("quorum") is None:
+                task_needed.append(None)
+                continue
+            task_targets = [device for device in targets if completed is None or not completed(index, device)]
+            task_needed.append(min(len(task_targets), Utilities.resolve_amount(task["quorum"], len(task_targets))))
+
+        async def device_worker(device: str) -> None:
+            nonlocal finished
+            answered_all = True
+
+            async def run_task(index: int) -> None:
+                nonlocal answered_all
+                task = tasks[index]
+                if completed is not None and completed(index, device):
+                    return
+                if task_cut_offs[index].is_set():
+                    answered_all = False
+                    await record(index, device, Executor.timed_out_response(command_of(index, device), True))
+                    return
+
+                if index not in announced: # Announce a task once, when the first device reaches it.
+                    announced.add(index)
+                    Console.print_text(silent,
+                                       Console.text_color.green + str(index + 1) + ". Running: " + task["name"])
+
+                async def count(node: str, device_response: dict) -> None:
+                    nonlocal answered_all
+                    Metrics.observe("meshbook_task_duration_seconds", time.perf_counter() - task_start, meshbook=meshbook.get("name", ""), task=task["name"])
+                    if device_response.get("timed_out", False):
+                        answered_all = False
+                    else:
+                        task_answered[index] += 1
+                        if task_needed[index] is not None and task_answered[index] >= task_needed[index]:
+                            task_cut_offs[index].set()
+                    await record(index, node, device_response)
+
+                task_start = time.perf_counter()
+                await Executor.dispatch(session, [device], command_of(index, device), meshbook, task, count, task_cut_offs[index], in_flight)
+
+            await Executor.run_graph(dependencies, task_delay, run_task)
+            if answered_all:
+                finished += 1
+                if finished >= needed:
+                    for task_cut_off in task_cut_offs:
+                        task_cut_off.set()
 
-        # Return the result 
-        return Transform.process_shell_response(enable_shlex, complete_log)
\ No newline at end of file
+        await asyncio.gather(*(device_worker(device) for device in targets))
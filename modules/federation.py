@@ -0,0 +1,63 @@
+# Public Python libraries
+import asyncio
+import meshctrl
+
+# Local Python libraries/modules
+from modules.inventory import Inventory
+from modules.session_pool import SessionPool
+
+class Federation():
+    def __init__(self, sessions: dict[str, meshctrl.Session | SessionPool]) -> None:
+        '''
+        Sessions to several MeshCentral servers (server name -> session), used like a single meshctrl.Session.
+        list_devices lists every server at once and tags every device with the server it belongs to,
+        run_command sends every device to its own server and merges the responses.
+        '''
+        self.sessions = sessions
+        self.server_of: dict[str, str] = {} # nodeid -> server name.
+
+    def use_inventory(self, inventory: Inventory) -> None:
+        '''
+        Learn which server every device belongs to from an inventory that was not listed through this federation (the cache).
+        '''
+
+        for server, nodeids in inventory.by_server.items():
+            for nodeid in nodeids:
+                self.server_of[nodeid] = server
+
+    async def list_devices(self, *args, group: str | None = None, **kwargs) -> list:
+        async def list_server(server: str, session: meshctrl.Session | SessionPool) -> list:
+            try:
+                devices = await session.list_devices(*args, group=group, **kwargs)
+            except meshctrl.exceptions.ServerError:
+                if group is None:
+                    raise
+                return [] # The group only exists on some of the servers.
+
+            for device in devices:
+                device.server = server
+                self.server_of[device.nodeid] = server
+            return devices
+
+        responses = await asyncio.gather(*(list_server(server, session) for server, session in self.sessions.items()))
+        return [device for devices in responses for device in devices]
+
+    async def run_command(self, nodeids, command, **kwargs) -> dict:
+        if isinstance(nodeids, str):
+            nodeids = [nodeids]
+
+        per_server = {}
+        for nodeid in nodeids:
+            if nodeid not in self.server_of:
+                raise ValueError(f"Invalid device id {nodeid}, it is not known on any of the servers.")
+            per_server.setdefault(self.server_of[nodeid], []).append(nodeid)
+
+        responses = await asyncio.gather(*(self.sessions[server].run_command(server_nodeids, command, **kwargs) for server, server_nodeids in per_server.items()))
+
+        merged = {}
+        for response in responses:
+            merged.update(response)
+        return merged
+
+    async def close(self) -> None:
+        await asyncio.gather(*(session.close() for session in self.sessions.values()))
@@ -1,15 +1,45 @@
+import gzip
+import json
 import os
+import re
+import shutil
+import threading
+import time
 from datetime import datetime
 
 from modules.console import Console
+from modules.history_store import HistoryStore
 
 class History():
-    def __init__(self, silent: bool, history_directory: str, flush_history: bool) -> None:
+    def __init__(self,
+                 silent: bool,
+                 history_directory: str,
+                 flush_history: bool,
+                 backend: str = "files",
+                 max_age_days: float = 0,
+                 max_count: int = 0,
+                 max_bytes: int = 0,
+                 compress_after_days: float = 0) -> None:
         '''
         Init function to declare some stuff and make sure we are good to go, mostly the directory.
+        With the sqlite backend runs are stored in history.sqlite3 (see HistoryStore) instead of a file per run.
+
+        Every history file is registered in manifest.ndjson, so startup and retention never have to list the directory.
+        Startup only reads manifest.summary.json (count, bytes and the oldest entries), the manifest itself is read once the retention has work to do.
+        Retention (0 disables a limit): files older than compress_after_days are gzipped into a dated subdirectory,
+        files older than max_age_days are removed, and then the oldest files until at most max_count files and max_bytes bytes are left.
         '''
         self.silent = silent
         self.history_directory = history_directory
+        self.manifest_file = f"{history_directory}/manifest.ndjson"
+        self.summary_file = f"{history_directory}/manifest.summary.json"
+        self.entries = None # Oldest first, loaded on demand.
+        self.store = None
+
+        self.max_age_days = max_age_days
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.compress_after_days = compress_after_days
 
         if not os.path.exists(history_directory):
             Console.print_text(silent, "Directory absent, trying to create it now...")
@@ -21,14 +51,19 @@ class History():
                 Console.print_text(silent, Console.text_color.red + f"Failed to create directory, permission error.")
                 return
 
-        history_items = os.listdir(history_directory)
-        if len(history_items) == 1:
-            Console.print_text(silent, f"There is {len(history_items)} history item.")
+        if flush_history:
+            self.remove_history(os.listdir(history_directory))
+
+        self.summary = self.load_summary()
+        if self.summary["count"] == 1:
+            Console.print_text(silent, f"There is {self.summary['count']} history item.")
         else:
-            Console.print_text(silent, f"There are {len(history_items)} history items.")
+            Console.print_text(silent, f"There are {self.summary['count']} history items.")
 
-        if flush_history:
-            self.remove_history(history_items)
+        if backend == "sqlite":
+            self.store = HistoryStore(f"{history_directory}/history.sqlite3")
+
+        self.apply_retention()
 
     def remove_history(self, history_items: list[str]) -> None:
         if not os.access(self.history_directory, os.W_OK):
@@ -39,10 +74,415 @@ class History():
             stitched_path = f"{self.history_directory}/{item}"
 
             Console.print_text(self.silent, f"Removing: {item}.")
+            if os.path.isdir(stitched_path): # Spilled outputs or a dated subdirectory.
+                shutil.rmtree(stitched_path)
+            else:
+                os.remove(stitched_path)
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def load_manifest(self) -> list[dict]:
+        '''
+        Read the manifest, a history directory without one (from before the manifest existed) is scanned once to create it.
+        A later line for the same path (see update_entry) replaces the earlier one.
+        '''
+
+        if os.path.exists(self.manifest_file):
+            entries = {}
+            with open(self.manifest_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        entries[entry["path"]] = entry
+            return list(entries.values())
+
+        entries = []
+        for item in os.scandir(self.history_directory):
+            if item.is_file() and item.name.startswith("meshbook_run_"):
+                spill_directory = os.path.splitext(item.name)[0] + "_output"
+                entries.append({
+                    "path": item.name,
+                    "created": item.stat().st_mtime,
+                    "bytes": item.stat().st_size + History.directory_size(f"{self.history_directory}/{spill_directory}"),
+                    "spill": spill_directory if os.path.isdir(f"{self.history_directory}/{spill_directory}") else None
+                })
+        entries.sort(key=lambda entry: entry["created"])
+        self.write_manifest(entries)
+        return entries
+
+    def write_manifest(self, entries: list[dict]) -> None:
+        temporary_file = self.manifest_file + ".tmp"
+        with open(temporary_file, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temporary_file, self.manifest_file)
+        self.write_summary(self.summarize(entries))
+
+    def load_summary(self) -> dict:
+        '''
+        Read the summary of the manifest. It records the manifest size it belongs to, a summary that is missing or does not match
+        (another meshbook process appended to the manifest) is rebuilt from the full manifest.
+        '''
+
+        try:
+            with open(self.summary_file, "r") as f:
+                summary = json.load(f)
+            if summary["manifest_bytes"] == os.path.getsize(self.manifest_file):
+                return summary
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self.entries = self.load_manifest()
+        summary = self.summarize(self.entries)
+        self.write_summary(summary)
+        return summary
+
+    def summarize(self, entries: list[dict]) -> dict:
+        return {
+            "count": len(entries),
+            "bytes": sum(entry["bytes"] for entry in entries),
+            "oldest": min((entry["created"] for entry in entries), default=None),
+            "oldest_uncompressed": min((entry["created"] for entry in entries if not entry["path"].endswith(".gz")), default=None),
+            "manifest_bytes": os.path.getsize(self.manifest_file) if os.path.exists(self.manifest_file) else 0
+        }
+
+    def write_summary(self, summary: dict) -> None:
+        self.summary = summary
+        temporary_file = self.summary_file + ".tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(summary, f)
+        os.replace(temporary_file, self.summary_file)
+
+    def register(self, stitched_file: str | None, spill_directory: str | None = None) -> dict | None:
+        '''
+        Add a history file (and the directory for its spilled outputs) to the manifest and return its entry.
+        Appending a single line keeps this cheap, also with tens of thousands of history files.
+        A stream is registered as soon as it is opened, so the retention covers it even when the run never finishes, and updated once it is closed.
+        '''
+
+        if stitched_file is None:
+            return None
+
+        entry = {
+            "path": os.path.relpath(stitched_file, self.history_directory),
+            "created": time.time(),
+            "bytes": os.path.getsize(stitched_file) + History.directory_size(spill_directory),
+            "spill": None if spill_directory is None else os.path.relpath(spill_directory, self.history_directory)
+        }
+        if self.entries is not None:
+            self.entries.append(entry)
+        with open(self.manifest_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+        summary = self.summary
+        self.write_summary({
+            "count": summary["count"] + 1,
+            "bytes": summary["bytes"] + entry["bytes"],
+            "oldest": min(summary["oldest"] or entry["created"], entry["created"]),
+            "oldest_uncompressed": min(summary["oldest_uncompressed"] or entry["created"], entry["created"]),
+            "manifest_bytes": os.path.getsize(self.manifest_file)
+        })
+
+        if self.retention_due():
+            self.apply_retention()
+        return entry
+
+    def update_entry(self, entry: dict | None, spill_directory: str | None = None) -> None:
+        '''
+        Record the final size and spill directory of a registered history file, like a stream that was closed.
+        The entry is appended again instead of rewriting the manifest, load_manifest keeps the last line of a path.
+        '''
+
+        if entry is None:
+            return
+
+        previous_bytes = entry["bytes"]
+        stitched_file = f"{self.history_directory}/{entry['path']}"
+        entry["spill"] = None if spill_directory is None else os.path.relpath(spill_directory, self.history_directory)
+        entry["bytes"] = (os.path.getsize(stitched_file) if os.path.exists(stitched_file) else 0) + History.directory_size(spill_directory)
+        with open(self.manifest_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+        self.write_summary({
+            **self.summary,
+            "bytes": self.summary["bytes"] - previous_bytes + entry["bytes"],
+            "manifest_bytes": os.path.getsize(self.manifest_file)
+        })
+
+        if self.retention_due():
+            self.apply_retention()
+
+    @staticmethod
+    def directory_size(directory: str | None) -> int:
+        if directory is None or not os.path.isdir(directory):
+            return 0
+        return sum(item.stat().st_size for item in os.scandir(directory) if item.is_file())
+
+    def retention_due(self) -> bool:
+        '''
+        Whether a retention limit is exceeded, decided on the summary alone.
+        '''
+
+        now = time.time()
+        summary = self.summary
+        return bool((self.max_count and summary["count"] > self.max_count)
+                    or (self.max_bytes and summary["bytes"] > self.max_bytes)
+                    or (self.max_age_days and summary["oldest"] is not None and now - summary["oldest"] > self.max_age_days * 86400)
+                    or (self.compress_after_days and summary["oldest_uncompressed"] is not None and now - summary["oldest_uncompressed"] > self.compress_after_days * 86400))
+
+    def apply_retention(self) -> None:
+        if self.store is not None and (self.max_age_days or self.max_count):
+            self.store.prune(self.max_age_days, self.max_count)
+
+        if not self.retention_due():
+            return
+
+        if self.entries is None:
+            self.entries = self.load_manifest()
+        now = time.time()
+        changed = False
+
+        if self.compress_after_days:
+            for entry in self.entries:
+                if not entry["path"].endswith(".gz") and now - entry["created"] > self.compress_after_days * 86400:
+                    self.compress_entry(entry)
+                    changed = True
+
+        keep = []
+        total_bytes = sum(entry["bytes"] for entry in self.entries)
+        for position, entry in enumerate(self.entries): # Oldest first.
+            newer_entries = len(self.entries) - position - 1
+            if ((self.max_age_days and now - entry["created"] > self.max_age_days * 86400)
+                or (self.max_count and newer_entries >= self.max_count)
+                or (self.max_bytes and total_bytes > self.max_bytes)):
+                self.remove_entry(entry)
+                total_bytes -= entry["bytes"]
+                changed = True
+            else:
+                keep.append(entry)
+
+        if changed:
+            self.entries = keep
+            self.write_manifest(keep)
+
+    def compress_entry(self, entry: dict) -> None:
+        '''
+        Gzip a history file into a subdirectory named after the day it was written, its spilled outputs (already gzipped) move along.
+        The log references them relative to its own directory (see OutputSpill.write), so those references stay valid after the move.
+        '''
+
+        dated_directory = datetime.fromtimestamp(entry["created"]).strftime("%Y_%m_%d")
+        os.makedirs(f"{self.history_directory}/{dated_directory}", exist_ok=True)
+
+        source = f"{self.history_directory}/{entry['path']}"
+        target = f"{dated_directory}/{os.path.basename(entry['path'])}.gz"
+        if os.path.exists(source):
+            with open(source, "rb") as original, gzip.open(f"{self.history_directory}/{target}", "wb") as compressed:
+                shutil.copyfileobj(original, compressed)
+            os.remove(source)
+        entry["path"] = target
+
+        if entry.get("spill") and os.path.isdir(f"{self.history_directory}/{entry['spill']}"):
+            spill_target = f"{dated_directory}/{os.path.basename(entry['spill'])}"
+            os.replace(f"{self.history_directory}/{entry['spill']}", f"{self.history_directory}/{spill_target}")
+            entry["spill"] = spill_target
+
+        entry["bytes"] = (os.path.getsize(f"{self.history_directory}/{target}") if os.path.exists(f"{self.history_directory}/{target}") else 0) + \
+                         History.directory_size(f"{self.history_directory}/{entry['spill']}" if entry.get("spill") else None)
+
+    def remove_entry(self, entry: dict) -> None:
+        Console.print_text(self.silent, f"Removing: {entry['path']}.")
+        stitched_path = f"{self.history_directory}/{entry['path']}"
+        if os.path.exists(stitched_path):
             os.remove(stitched_path)
+        if entry.get("spill") and os.path.isdir(f"{self.history_directory}/{entry['spill']}"):
+            shutil.rmtree(f"{self.history_directory}/{entry['spill']}")
 
-    def write_history(self, history: dict) -> bool:
-        stitched_file = f"{self.history_directory}/meshbook_run_{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}.log"
+        dated_directory = os.path.dirname(stitched_path)
+        if dated_directory != self.history_directory and os.path.isdir(dated_directory) and len(os.listdir(dated_directory)) == 0:
+            os.rmdir(dated_directory)
 
-        with open(stitched_file, "x") as f:
+    def file_stem(self, name: str | None = None) -> str:
+        '''
+        Name of a history file without extension, batch runs add the meshbook name so every meshbook gets its own file.
+        '''
+
+        stem = f"meshbook_run_{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}"
+        if name:
+            stem += f"_{name}"
+        return stem
+
+    @staticmethod
+    def open_unique(stitched_file: str, **open_arguments):
+        '''
+        Create a new file, a counter is added to the name when the file exists already (two runs finishing in the same second).
+        Returns the name that was used and the open file.
+        '''
+
+        base, extension = os.path.splitext(stitched_file)
+        counter = 0
+        while True:
+            try:
+                return stitched_file, open(stitched_file, "x", **open_arguments)
+            except FileExistsError:
+                counter += 1
+                stitched_file = f"{base}_{counter}{extension}"
+
+    def write_history(self, history: str, name: str | None = None, spill_directory: str | None = None) -> str:
+        stitched_file, f = History.open_unique(f"{self.history_directory}/{self.file_stem(name)}.log")
+        with f:
             f.write(history)
+
+        self.register(stitched_file, spill_directory)
+        return stitched_file
+
+    def spill_directory(self, name: str | None = None) -> str:
+        '''
+        Directory next to the history file of a run, for the full outputs that were truncated in the log (see OutputSpill).
+        '''
+
+        return f"{self.history_directory}/{self.file_stem(name)}_output"
+
+    def open_stream(self, meshbook_file: str, tasks: list[dict], write_file: bool = True, indent: int | None = None, name: str | None = None, mirror=None) -> "HistoryStream":
+        '''
+        Open a streaming history file (NDJSON), every result gets appended as its own line as soon as it is known.
+        '''
+
+        stitched_file = None
+        if write_file:
+            stitched_file = f"{self.history_directory}/{self.file_stem(name)}.ndjson"
+
+        return HistoryStream(self.silent, stitched_file, meshbook_file, tasks, indent, mirror)
+
+    @staticmethod
+    def rebuild_log(stream_file: str) -> dict:
+        '''
+        Read a streaming history file back into the regular (non-streaming) JSON layout.
+        '''
+
+        complete_log = {}
+        sections = {}
+        aggregated = {}
+
+        with (gzip.open(stream_file, "rt") if stream_file.endswith(".gz") else open(stream_file, "r")) as f: # Compressed by the retention.
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+
+                match record.pop("record", None):
+                    case "run":
+                        for index, task_name in enumerate(record["tasks"]):
+                            complete_log["task_" + str(index + 1)] = {"task_name": task_name, "data": []}
+                    case "result":
+                        task_key = record.pop("task")
+                        task_name = record.pop("task_name")
+                        if "output_hash" in record: # Aggregated output, the devices that returned it as well follow as duplicate records.
+                            record["devices"] = [{"device_id": record.pop("device_id"), "device_name": record.pop("device_name")}]
+                            aggregated[(task_key, record["output_hash"])] = record
+                        complete_log.setdefault(task_key, {"task_name": task_name, "data": []})["data"].append(record)
+                    case "duplicate":
+                        aggregated[(record["task"], record["output_hash"])]["devices"].append({"device_id": record["device_id"], "device_name": record["device_name"]})
+                    case "section":
+                        sections[record["section"]] = record["devices"]
+
+        complete_log.update(sections)
+        return complete_log
+
+class HistoryStream():
+    def __init__(self, silent: bool, stitched_file: str | None, meshbook_file: str, tasks: list[dict], indent: int | None = None, mirror=None) -> None:
+        '''
+        Result sink for the Executor that writes one JSON record per line instead of keeping everything in memory.
+        The file is line buffered, so whatever was received before a crash is on disk.
+        mirror is an optional callable that receives every line as well (the daemon uses it to stream to the caller).
+        '''
+        self.silent = silent
+        self.mirror = mirror
+        self.stitched_file = stitched_file
+        self.indent = indent
+        self.tasks = tasks
+        self.record_count = 0
+        self.file = None
+
+        if stitched_file is not None:
+            self.stitched_file, self.file = History.open_unique(stitched_file, buffering=1)
+
+        self.write_record({
+            "record": "run",
+            "meshbook": meshbook_file,
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "tasks": [task["name"] for task in tasks]
+        })
+
+    def write_record(self, record: dict) -> None:
+        line = json.dumps(record) + "\n"
+        if self.file is not None:
+            self.file.write(line)
+        if self.mirror is not None:
+            self.mirror(line)
+        if not self.silent:
+            Console.print_text(self.silent, json.dumps(record, indent=self.indent), 9)
+        self.record_count += 1
+
+    def add_result(self, index: int, device_response: dict) -> None:
+        self.write_record({
+            "record": "result",
+            "task": "task_" + str(index + 1),
+            "task_name": self.tasks[index]["name"],
+            **device_response
+        })
+
+    def add_duplicate(self, index: int, output_hash: str, device_id: str, device_name: str) -> None:
+        self.write_record({
+            "record": "duplicate",
+            "task": "task_" + str(index + 1),
+            "output_hash": output_hash,
+            "device_id": device_id,
+            "device_name": device_name
+        })
+
+    def add_section(self, name: str, device_names: list[str]) -> None:
+        self.write_record({"record": "section", "section": name, "devices": device_names})
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class OutputSpill():
+    def __init__(self, spill_directory: str) -> None:
+        '''
+        Keeps the full output of a device when the log only holds a truncated version (max_output_bytes).
+        Every output gets its own gzip file, the log references it by path and by the sha256 of the uncompressed output.
+        The path is relative to the directory of the history file (the parent of spill_directory), so it resolves from anywhere
+        and keeps resolving when the retention moves the history file and its spill directory into a dated subdirectory together.
+        The directory is only created for the first spilled output, spill_directory stays None when nothing was spilled.
+        '''
+        self.requested_directory = spill_directory
+        self.spill_directory = None
+        self.lock = threading.Lock() # Outputs are written from worker threads.
+
+    def create_directory(self) -> None:
+        base = self.requested_directory
+        counter = 0
+        while self.spill_directory is None:
+            try:
+                os.makedirs(self.requested_directory)
+                self.spill_directory = self.requested_directory
+            except FileExistsError: # Another run started in the same second.
+                counter += 1
+                self.requested_directory = f"{base}_{counter}"
+
+    def write(self, task_number: int, device_id: str, output: bytes) -> dict:
+        with self.lock:
+            if self.spill_directory is None:
+                self.create_directory()
+
+        file_name = f"task_{task_number}_{re.sub(r'[^A-Za-z0-9_.-]', '_', device_id)}.gz"
+        with gzip.open(f"{self.spill_directory}/{file_name}", "wb", compresslevel=6) as f:
+            f.write(output)
+
+        return {"spill_file": f"{os.path.basename(self.spill_directory)}/{file_name}"}
@@ -0,0 +1,240 @@
+# Public Python libraries
+from datetime import datetime, timedelta
+import json
+import os
+import re
+import shutil
+import sqlite3
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    meshbook TEXT NOT NULL,
+    meshbook_file TEXT NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    spill_directory TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    task TEXT NOT NULL,
+    task_name TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    device_name TEXT NOT NULL,
+    complete INTEGER NOT NULL,
+    started TEXT NOT NULL,
+    response TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sections (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    section TEXT NOT NULL,
+    device_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_meshbook ON runs (meshbook, started);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS results_device ON results (device_name COLLATE NOCASE, started);
+CREATE INDEX IF NOT EXISTS results_task ON results (task_name, started);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+CREATE INDEX IF NOT EXISTS sections_run ON sections (run_id);
+'''
+
+class HistoryStore():
+    def __init__(self, database_file: str) -> None:
+        '''
+        SQLite history backend: a row per run and a row per task and device, indexed on device, meshbook, task name and time.
+        The "history query" action reads it, so questions about earlier runs do not need every history file to be parsed.
+        '''
+        self.database_file = database_file
+        self.connection = sqlite3.connect(database_file)
+        self.connection.execute("PRAGMA journal_mode=WAL") # Queries keep working while a run writes.
+        self.connection.executescript(schema)
+        if "spill_directory" not in {column[1] for column in self.connection.execute("PRAGMA table_info(runs)")}: # Created before the column existed.
+            self.connection.execute("ALTER TABLE runs ADD COLUMN spill_directory TEXT")
+
+    def begin_run(self, meshbook_file: str) -> tuple[int, str]:
+        started = datetime.now().isoformat(timespec="seconds")
+        cursor = self.connection.execute("INSERT INTO runs (meshbook, meshbook_file, started) VALUES (?, ?, ?)",
+                                         (os.path.splitext(os.path.basename(meshbook_file))[0], meshbook_file, started))
+        return cursor.lastrowid, started
+
+    def add_result(self, run_id: int, started: str, task: str, task_name: str, device_response: dict) -> str:
+        '''
+        Add the rows of a response, an aggregated response gets a row for every device in its "devices" list.
+        Returns the stored response, so devices with the same output can be added later on with add_row.
+        '''
+
+        response = json.dumps({key: value for key, value in device_response.items() if key not in ("device_id", "device_name", "devices")})
+        devices = device_response.get("devices", [{"device_id": device_response.get("device_id", ""), "device_name": device_response.get("device_name", "")}])
+        for device in devices:
+            self.add_row(run_id, started, task, task_name, device["device_id"], device["device_name"], device_response.get("complete", False), response)
+        return response
+
+    def add_row(self, run_id: int, started: str, task: str, task_name: str, device_id: str, device_name: str, complete: bool, response: str) -> None:
+        self.connection.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (run_id, task, task_name, device_id, device_name, int(bool(complete)), started, response))
+
+    def add_section(self, run_id: int, section: str, device_names: list[str]) -> None:
+        self.connection.executemany("INSERT INTO sections VALUES (?, ?, ?)",
+                                    [(run_id, section, device_name) for device_name in device_names])
+
+    def finish_run(self, run_id: int) -> None:
+        self.connection.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (datetime.now().isoformat(timespec="seconds"), run_id))
+        self.connection.commit()
+
+    def set_spill_directory(self, run_id: int, spill_directory: str | None) -> None:
+        '''
+        Remember the directory with the spilled outputs of a run (relative to the database), prune removes it together with the run.
+        '''
+
+        if spill_directory is None:
+            return
+        self.connection.execute("UPDATE runs SET spill_directory = ? WHERE run_id = ?",
+                                (os.path.relpath(spill_directory, os.path.dirname(self.database_file)), run_id))
+        self.connection.commit()
+
+    def write_log(self, meshbook_file: str, complete_log: dict) -> int:
+        '''
+        Store a complete (non-streamed) log in one transaction, returns the run id.
+        '''
+
+        run_id, started = self.begin_run(meshbook_file)
+        for task, task_data in complete_log.items():
+            if task in ("Offline", "Skipped"):
+                self.add_section(run_id, task, task_data)
+                continue
+            for device_response in task_data["data"]:
+                self.add_result(run_id, started, task, task_data["task_name"], device_response)
+        self.finish_run(run_id)
+        return run_id
+
+    def open_run(self, meshbook_file: str, tasks: list[dict], mirror=None) -> "HistoryStoreRun":
+        return HistoryStoreRun(self, meshbook_file, tasks, mirror)
+
+    @staticmethod
+    def parse_since(since: str) -> str:
+        '''
+        Turn a relative age ("30d", "12h", "15m") or an ISO date/time into the ISO time the query starts at.
+        '''
+
+        match = re.fullmatch(r"(\d+)([dhm])", since.strip())
+        if match is None:
+            return datetime.fromisoformat(since.strip()).isoformat(timespec="seconds")
+
+        amount = int(match.group(1))
+        age = {"d": timedelta(days=amount), "h": timedelta(hours=amount), "m": timedelta(minutes=amount)}[match.group(2)]
+        return (datetime.now() - age).isoformat(timespec="seconds")
+
+    def query(self,
+              device: str = "",
+              task: str = "",
+              meshbook: str = "",
+              since: str = "",
+              status: str = "",
+              limit: int = 100) -> list[dict]:
+        '''
+        Results of earlier runs, newest first. Device names match case insensitive, meshbook matches the file name without extension.
+        '''
+
+        conditions = []
+        parameters = []
+
+        if device:
+            conditions.append("results.device_name = ? COLLATE NOCASE")
+            parameters.append(device)
+        if task:
+            conditions.append("results.task_name = ?")
+            parameters.append(task)
+        if meshbook:
+            conditions.append("runs.meshbook = ?")
+            parameters.append(os.path.splitext(os.path.basename(meshbook))[0])
+        if since:
+            conditions.append("results.started >= ?")
+            parameters.append(HistoryStore.parse_since(since))
+        if status:
+            conditions.append("results.complete = ?")
+            parameters.append(1 if status == "complete" else 0)
+
+        statement = ("SELECT runs.run_id, runs.meshbook, results.started, results.task, results.task_name, results.device_id, results.device_name, results.response "
+                     "FROM results JOIN runs ON runs.run_id = results.run_id")
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        statement += " ORDER BY results.started DESC, results.run_id DESC, results.rowid LIMIT ?"
+        parameters.append(limit)
+
+        rows = []
+        for run_id, meshbook_name, started, task_key, task_name, device_id, device_name, response in self.connection.execute(statement, parameters):
+            rows.append({
+                "run_id": run_id,
+                "meshbook": meshbook_name,
+                "started": started,
+                "task": task_key,
+                "task_name": task_name,
+                "device_id": device_id,
+                "device_name": device_name,
+                **json.loads(response)
+            })
+        return rows
+
+    def prune(self, max_age_days: float = 0, max_count: int = 0) -> None:
+        '''
+        Remove the runs (with their results and spilled outputs) older than max_age_days, and all but the newest max_count runs.
+        '''
+
+        selections = []
+        if max_age_days:
+            selections.append(("SELECT run_id FROM runs WHERE started < ?", ((datetime.now() - timedelta(days=max_age_days)).isoformat(timespec="seconds"),)))
+        if max_count:
+            selections.append(("SELECT run_id FROM runs ORDER BY run_id DESC LIMIT -1 OFFSET ?", (max_count,)))
+
+        for selection, parameters in selections:
+            for (spill_directory,) in self.connection.execute(f"SELECT spill_directory FROM runs WHERE spill_directory IS NOT NULL AND run_id IN ({selection})", parameters).fetchall():
+                shutil.rmtree(os.path.join(os.path.dirname(self.database_file), spill_directory), ignore_errors=True)
+            for table in ("results", "sections", "runs"): # The runs table last, the selection reads it.
+                self.connection.execute(f"DELETE FROM {table} WHERE run_id IN ({selection})", parameters)
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+class HistoryStoreRun():
+    def __init__(self, store: HistoryStore, meshbook_file: str, tasks: list[dict], mirror=None) -> None:
+        '''
+        Result sink for the Executor that inserts every response as soon as it arrives, committed in batches.
+        mirror is an optional sink (like a HistoryStream without a file) that receives every result as well.
+        '''
+        self.store = store
+        self.tasks = tasks
+        self.mirror = mirror
+        self.record_count = 0
+        self.aggregated = {}
+        self.run_id, self.started = store.begin_run(meshbook_file)
+
+    def add_result(self, index: int, device_response: dict) -> None:
+        response = self.store.add_result(self.run_id, self.started, "task_" + str(index + 1), self.tasks[index]["name"], device_response)
+        if "output_hash" in device_response:
+            self.aggregated[(index, device_response["output_hash"])] = (device_response.get("complete", False), response)
+        self.commit_batch()
+        if self.mirror is not None:
+            self.mirror.add_result(index, device_response)
+
+    def add_duplicate(self, index: int, output_hash: str, device_id: str, device_name: str) -> None:
+        complete, response = self.aggregated[(index, output_hash)]
+        self.store.add_row(self.run_id, self.started, "task_" + str(index + 1), self.tasks[index]["name"], device_id, device_name, complete, response)
+        self.commit_batch()
+        if self.mirror is not None:
+            self.mirror.add_duplicate(index, output_hash, device_id, device_name)
+
+    def commit_batch(self) -> None:
+        self.record_count += 1
+        if self.record_count % 500 == 0:
+            self.store.connection.commit()
+
+    def add_section(self, name: str, device_names: list[str]) -> None:
+        self.store.add_section(self.run_id, name, device_names)
+        if self.mirror is not None:
+            self.mirror.add_section(name, device_names)
+
+    def close(self) -> None:
+        self.store.finish_run(self.run_id)
+        if self.mirror is not None:
+            self.mirror.close()
@@ -0,0 +1,207 @@
+# Public Python libraries
+from __future__ import annotations
+import json
+import os
+import re
+import time
+from typing import TYPE_CHECKING
+
+# Local Python libraries/modules
+from modules.console import Console
+
+if TYPE_CHECKING:
+    import meshctrl
+
+class Inventory:
+    def __init__(self) -> None:
+        '''
+        Holds every device known to the MeshCentral account for a single run, with hash indexes so lookups never walk the whole fleet.
+
+        groups: meshname -> [device dicts]
+        by_id: nodeid -> device dict
+        by_name: lowercased device name -> [device dicts] (names are not unique in MeshCentral)
+        by_group: lowercased meshname -> [device dicts]
+        group_of: nodeid -> meshname
+        by_tag: tag -> {nodeids}
+        by_os: reported OS string -> {nodeids}
+        by_server: server name -> {nodeids} (only with several servers, see Federation)
+        '''
+        self.groups: dict[str, list[dict]] = {}
+        self.by_id: dict[str, dict] = {}
+        self.by_name: dict[str, list[dict]] = {}
+        self.by_group: dict[str, list[dict]] = {}
+        self.group_of: dict[str, str] = {}
+        self.fetched_fully = False # True when built from a full device listing (not from the cache).
+        self.by_tag: dict[str, set[str]] = {}
+        self.by_os: dict[str, set[str]] = {}
+        self.by_server: dict[str, set[str]] = {}
+
+    @classmethod
+    async def from_session(cls, session: meshctrl.Session) -> "Inventory":
+        '''
+        Retrieve the devices from MeshCentral and index them.
+        '''
+
+        devices_response = await session.list_devices(details=False, timeout=10)
+
+        inventory = cls()
+        for device in devices_response:
+            inventory.add_device(device.meshname, Inventory.device_entry(device))
+        inventory.fetched_fully = True
+        return inventory
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Inventory":
+        inventory = cls()
+        for meshname, devices in data["groups"].items():
+            for device in devices:
+                inventory.add_device(meshname, device)
+        return inventory
+
+    def to_dict(self) -> dict:
+        return {"groups": self.groups}
+
+    @staticmethod
+    def device_entry(device: meshctrl.device.Device) -> dict:
+        entry = {
+            "device_id": device.nodeid,
+            "device_name": device.name,
+            "device_os": device.os_description,
+            "device_tags": device.tags,
+            "reachable": device.connected
+        }
+        if hasattr(device, "server"): # Tagged by the Federation when running against several servers.
+            entry["server"] = device.server
+        return entry
+
+    async def refresh_groups(self, session: meshctrl.Session, meshnames: set[str]) -> None:
+        '''
+        Re-fetch only the given groups from MeshCentral (new/removed devices and their connection state), the rest of the inventory is left alone.
+        '''
+
+        for meshname in meshnames:
+            devices_response = await session.list_devices(group=meshname, timeout=10)
+            self.remove_group(meshname)
+            for device in devices_response:
+                self.add_device(meshname, Inventory.device_entry(device))
+
+    def add_device(self, meshname: str, device: dict) -> None:
+        self.groups.setdefault(meshname, []).append(device)
+        self.by_group.setdefault(meshname.lower(), []).append(device)
+        self.by_id[device["device_id"]] = device
+        self.group_of[device["device_id"]] = meshname
+        self.by_name.setdefault(str(device["device_name"]).lower(), []).append(device)
+        self.by_os.setdefault(device["device_os"], set()).add(device["device_id"])
+
+        for tag in device["device_tags"]:
+            self.by_tag.setdefault(tag, set()).add(device["device_id"])
+        if "server" in device:
+            self.by_server.setdefault(device["server"], set()).add(device["device_id"])
+
+    def remove_group(self, meshname: str) -> None:
+        for device in self.groups.pop(meshname, []):
+            self.by_id.pop(device["device_id"], None)
+            self.group_of.pop(device["device_id"], None)
+
+            same_name = self.by_name.get(str(device["device_name"]).lower(), [])
+            if device in same_name:
+                same_name.remove(device)
+
+            self.by_os.get(device["device_os"], set()).discard(device["device_id"])
+            for tag in device["device_tags"]:
+                self.by_tag.get(tag, set()).discard(device["device_id"])
+            if "server" in device:
+                self.by_server.get(device["server"], set()).discard(device["device_id"])
+
+        self.by_group.pop(meshname.lower(), None)
+
+    def get(self, nodeid: str) -> dict | None:
+        return self.by_id.get(nodeid)
+
+    def name_of(self, nodeid: str) -> str:
+        '''
+        Look up the human-readable name of a nodeid, empty string if the node is unknown.
+        '''
+
+        device = self.by_id.get(nodeid)
+        if device is None:
+            return ""
+        return device["device_name"]
+
+    def find_by_name(self, name: str) -> list[dict]:
+        return self.by_name.get(name.lower(), [])
+
+    def group(self, name: str) -> list[dict] | None:
+        return self.by_group.get(name.lower())
+
+    def ids_with_tag(self, tag: str) -> set[str]:
+        return self.by_tag.get(tag, set())
+
+    def ids_with_os(self, os_description: str) -> set[str]:
+        return self.by_os.get(os_description, set())
+
+    def server_of(self, nodeid: str) -> str:
+        '''
+        The server a device belongs to, empty string with a single server.
+        '''
+
+        device = self.by_id.get(nodeid)
+        if device is None:
+            return ""
+        return device.get("server", "")
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+class InventoryCache:
+    def __init__(self, silent: bool, cache_directory: str, hostname: str, ttl: int) -> None:
+        '''
+        On-disk copy of the inventory, one file per MeshCentral server, trusted for ttl seconds.
+        The cache directory is only created by the first save, so a disabled cache (ttl 0) leaves nothing behind.
+        '''
+        self.silent = silent
+        self.ttl = ttl
+        self.cache_directory = cache_directory
+        self.cache_file = f"{cache_directory}/inventory_{re.sub(r'[^A-Za-z0-9_.-]', '_', hostname)}.json"
+
+    def load(self) -> Inventory | None:
+        '''
+        Return the cached inventory, or None when there is none or it is older than the TTL.
+        '''
+
+        if self.ttl <= 0 or not os.path.isfile(self.cache_file):
+            return None
+
+        try:
+            with open(self.cache_file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            Console.print_text(self.silent, Console.text_color.yellow + "Inventory cache unreadable, ignoring it.")
+            return None
+
+        age = time.time() - data.get("fetched", 0)
+        if age > self.ttl:
+            return None
+
+        Console.print_text(self.silent, f"Using cached inventory ({int(age)}s old).")
+        return Inventory.from_dict(data)
+
+    def save(self, inventory: Inventory) -> None:
+        if self.ttl <= 0:
+            return
+
+        if not os.path.exists(self.cache_directory):
+            try:
+                os.makedirs(self.cache_directory)
+
+            except PermissionError:
+                Console.print_text(self.silent, Console.text_color.red + "Failed to create inventory cache directory, permission error.")
+                return
+
+        temporary_file = self.cache_file + ".tmp"
+        try:
+            with open(temporary_file, "w") as f:
+                json.dump({"fetched": time.time(), **inventory.to_dict()}, f)
+            os.replace(temporary_file, self.cache_file) # Atomic, a parallel run never reads a half written cache.
+        except OSError as message:
+            Console.print_text(self.silent, Console.text_color.yellow + f"Unable to write the inventory cache: {message}")
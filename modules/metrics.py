@@ -0,0 +1,149 @@
+# Public Python libraries
+import os
+import time
+
+default_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+class Histogram:
+    def __init__(self) -> None:
+        self.bucket_counts = [0] * len(default_buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(default_buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+
+class Metrics:
+    '''
+    Run, task and device metrics in the Prometheus text format (version 0.0.4), for the node_exporter textfile collector or a Pushgateway.
+    Like the Profiler, every call returns immediately while metrics are not enabled.
+    '''
+
+    enabled = False
+    started = time.time()
+    histograms: dict[tuple, Histogram] = {}
+    counters: dict[tuple, int] = {}
+    gauges: dict[tuple, float] = {}
+
+    help_texts = {
+        "meshbook_task_duration_seconds": ("histogram", "Time a task took (whole fleet for linear, per device for pipelined)."),
+        "meshbook_device_response_seconds": ("histogram", "Time between dispatching a command and receiving the device response, for devices dispatched on their own."),
+        "meshbook_devices": ("counter", "Device outcomes per meshbook, succeeded/failed/timed_out are counted per task, offline/skipped once per run."),
+        "meshbook_retries": ("counter", "Times a task was dispatched again on a single device (retries)."),
+        "meshbook_inventory_devices": ("gauge", "Devices in the inventory of the MeshCentral account."),
+        "meshbook_login_duration_seconds": ("gauge", "Time the login to MeshCentral took."),
+        "meshbook_run_duration_seconds": ("gauge", "Wall time of the whole run."),
+        "meshbook_last_run_timestamp_seconds": ("gauge", "Unix time the run finished.")
+    }
+
+    @staticmethod
+    def enable() -> None:
+        Metrics.enabled = True
+        Metrics.started = time.time()
+        Metrics.histograms = {}
+        Metrics.counters = {}
+        Metrics.gauges = {}
+
+    @staticmethod
+    def observe(name: str, value: float, **labels) -> None:
+        if not Metrics.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        if key not in Metrics.histograms:
+            Metrics.histograms[key] = Histogram()
+        Metrics.histograms[key].observe(value)
+
+    @staticmethod
+    def count(name: str, amount: int = 1, **labels) -> None:
+        if not Metrics.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        Metrics.counters[key] = Metrics.counters.get(key, 0) + amount
+
+    @staticmethod
+    def set(name: str, value: float, **labels) -> None:
+        if not Metrics.enabled:
+            return
+        Metrics.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @staticmethod
+    def format_labels(labels: tuple, extra: str = "") -> str:
+        parts = []
+        for key, value in labels:
+            escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{key}="{escaped}"')
+        if extra:
+            parts.append(extra)
+        if not parts:
+            return ""
+        return "{" + ",".join(parts) + "}"
+
+    @staticmethod
+    def render() -> str:
+        '''
+        Render every metric in the Prometheus text format (version 0.0.4), the format the textfile collector and the Pushgateway parse.
+        Counter samples end in _total, so their HELP and TYPE lines use that name as well.
+        '''
+
+        Metrics.set("meshbook_run_duration_seconds", time.time() - Metrics.started)
+        Metrics.set("meshbook_last_run_timestamp_seconds", time.time())
+
+        lines = []
+        for name, (metric_type, help_text) in Metrics.help_texts.items():
+            family = name + "_total" if metric_type == "counter" else name
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {metric_type}")
+
+            if metric_type == "histogram":
+                for (metric_name, labels), histogram in Metrics.histograms.items():
+                    if metric_name != name:
+                        continue
+                    for bound, bucket_count in zip(default_buckets, histogram.bucket_counts):
+                        bucket_labels = Metrics.format_labels(labels, 'le="' + str(bound) + '"')
+                        lines.append(f"{name}_bucket{bucket_labels} {bucket_count}")
+                    bucket_labels = Metrics.format_labels(labels, 'le="+Inf"')
+                    lines.append(f"{name}_bucket{bucket_labels} {histogram.count}")
+                    lines.append(f"{name}_sum{Metrics.format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{Metrics.format_labels(labels)} {histogram.count}")
+
+            elif metric_type == "counter":
+                for (metric_name, labels), value in Metrics.counters.items():
+                    if metric_name == name:
+                        lines.append(f"{family}{Metrics.format_labels(labels)} {value}")
+
+            else:
+                for (metric_name, labels), value in Metrics.gauges.items():
+                    if metric_name == name:
+                        lines.append(f"{name}{Metrics.format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def write_textfile(textfile: str) -> None:
+        '''
+        Write atomically, the node_exporter textfile collector must never read a half written file.
+        '''
+
+        temporary_file = textfile + ".tmp"
+        with open(temporary_file, "w") as f:
+            f.write(Metrics.render())
+        os.replace(temporary_file, textfile)
+
+    @staticmethod
+    def push(url: str) -> None:
+        '''
+        PUT the metrics to a (local) Pushgateway style endpoint, like http://localhost:9091/metrics/job/meshbook.
+        '''
+
+        import urllib.request # Only a push needs it, and it pulls in http.client and ssl.
+
+        request = urllib.request.Request(url,
+                                         data=Metrics.render().encode(),
+                                         method="PUT",
+                                         headers={"Content-Type": "text/plain; version=0.0.4"})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
@@ -0,0 +1,86 @@
+# Public Python libraries
+import re
+
+# Local Python libraries/modules
+from modules.inventory import Inventory
+
+class OsMatcher:
+    def __init__(self, os_categories: dict) -> None:
+        '''
+        Compiles the Operating System categorisation (os_categories.json) once, so filtering is a couple of lookups per device.
+
+        categories: category -> frozenset of the exact OS strings somewhere below it (every nesting level is a category)
+        os_index: exact OS string -> frozenset of every category it belongs to
+        patterns: precompiled "prefix:" and "regex:" entries, with the categories they belong to
+        '''
+        categories = {}
+        os_index = {}
+        self.patterns: list[tuple[re.Pattern, frozenset[str]]] = []
+
+        def walk(node: dict | list, path: tuple[str, ...]) -> None:
+            if isinstance(node, dict):  # Expand nested categories
+                for key, value in node.items():
+                    categories.setdefault(key, set())
+                    walk(value, path + (key,))
+                return
+
+            for entry in node:  # Direct OS list
+                if entry.startswith("regex:"):
+                    self.patterns.append((re.compile(entry[len("regex:"):]), frozenset(path)))
+                elif entry.startswith("prefix:"):
+                    self.patterns.append((re.compile(re.escape(entry[len("prefix:"):])), frozenset(path)))
+                else:
+                    os_index.setdefault(entry, set()).update(path)
+                    for category in path:
+                        categories[category].add(entry)
+
+        walk(os_categories, ())
+
+        self.categories: dict[str, frozenset[str]] = {key: frozenset(value) for key, value in categories.items()}
+        self.os_index: dict[str, frozenset[str]] = {key: frozenset(value) for key, value in os_index.items()}
+        self.match_cache: dict[tuple, bool] = {}
+
+    def categories_of(self, os_description: str) -> frozenset[str]:
+        '''
+        Every category a reported OS string belongs to, patterns are only tried for strings that are not listed literally.
+        '''
+
+        if os_description in self.os_index:
+            return self.os_index[os_description]
+
+        matched = set()
+        for pattern, path in self.patterns:
+            if pattern.match(os_description or ""):
+                matched.update(path)
+
+        # Remember the outcome, fleets only report a handful of distinct OS strings.
+        self.os_index[os_description] = frozenset(matched)
+        return self.os_index[os_description]
+
+    def matches(self, os_description: str, target_os: str | None, ignore_categorisation: bool = False) -> bool:
+        '''
+        Whether a device OS fits the target_os, without a target_os every OS fits.
+        With ignore_categorisation the target_os only has to be part of the reported OS string.
+        '''
+
+        if not target_os:
+            return True
+
+        key = (os_description, target_os, ignore_categorisation)
+        if key not in self.match_cache:
+            if ignore_categorisation:
+                self.match_cache[key] = target_os in (os_description or "")
+            else:
+                self.match_cache[key] = target_os in self.categories_of(os_description)
+        return self.match_cache[key]
+
+    def device_ids(self, inventory: Inventory, target_os: str | None, ignore_categorisation: bool = False) -> set[str]:
+        '''
+        All nodeids in the inventory that fit the target_os, resolved once per distinct OS string instead of per device.
+        '''
+
+        matched = set()
+        for os_description, nodeids in inventory.by_os.items():
+            if self.matches(os_description, target_os, ignore_categorisation):
+                matched.update(nodeids)
+        return matched
@@ -0,0 +1,113 @@
+# Public Python libraries
+from contextlib import nullcontext
+import time
+
+class Span:
+    def __init__(self, name: str, category: str, args: dict) -> None:
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        Profiler.record(self.name, self.category, self.start, time.perf_counter_ns(), self.args)
+
+class Profiler:
+    '''
+    Collects timed spans of a run (phases, tasks, run_command calls and device responses) for --profile.
+    When it is not enabled, span() hands out one shared no-op context manager, so the instrumentation costs next to nothing.
+    '''
+
+    enabled = False
+    origin = time.perf_counter_ns()
+    spans: list[dict] = []
+    noop = nullcontext()
+
+    @staticmethod
+    def enable() -> None:
+        Profiler.enabled = True
+        Profiler.origin = time.perf_counter_ns()
+        Profiler.spans = []
+
+    @staticmethod
+    def span(name: str, category: str = "phase", **args) -> Span | nullcontext:
+        if not Profiler.enabled:
+            return Profiler.noop
+        return Span(name, category, args)
+
+    @staticmethod
+    def record(name: str, category: str, start_ns: int, end_ns: int, args: dict | None = None) -> None:
+        '''
+        Add a finished span, for timings that can not be wrapped in span() (like a device response).
+        '''
+
+        if not Profiler.enabled:
+            return
+        Profiler.spans.append({
+            "name": name,
+            "category": category,
+            "start_us": (start_ns - Profiler.origin) / 1000,
+            "duration_us": (end_ns - start_ns) / 1000,
+            "args": args or {}
+        })
+
+    @staticmethod
+    def chrome_trace() -> dict:
+        '''
+        Convert the spans to the Chrome trace-event format (chrome://tracing, Perfetto, speedscope).
+        Phases get their own lane, tasks (independent tasks run concurrently), run_command calls and device responses can overlap so they become async events.
+        '''
+
+        lanes = {"phase": 1}
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": category}}
+            for category, lane in lanes.items()
+        ]
+
+        for event_id, span in enumerate(Profiler.spans):
+            if span["category"] in lanes:
+                trace_events.append({
+                    "name": span["name"],
+                    "cat": span["category"],
+                    "ph": "X",
+                    "ts": span["start_us"],
+                    "dur": span["duration_us"],
+                    "pid": 1,
+                    "tid": lanes[span["category"]],
+                    "args": span["args"]
+                })
+            else:
+                for phase, timestamp in (("b", span["start_us"]), ("e", span["start_us"] + span["duration_us"])):
+                    trace_events.append({
+                        "name": span["name"],
+                        "cat": span["category"],
+                        "ph": phase,
+                        "ts": timestamp,
+                        "id": event_id,
+                        "pid": 1,
+                        "tid": 2,
+                        "args": span["args"] if phase == "b" else {}
+                    })
+
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    @staticmethod
+    def write(profile_path: str) -> list[str]:
+        '''
+        Write the spans as plain JSON and as a Chrome trace, returns both file names.
+        '''
+
+        import json
+
+        spans_file = f"{profile_path}.spans.json"
+        trace_file = f"{profile_path}.trace.json"
+
+        with open(spans_file, "w") as f:
+            json.dump(Profiler.spans, f)
+        with open(trace_file, "w") as f:
+            json.dump(Profiler.chrome_trace(), f)
+
+        return [spans_file, trace_file]
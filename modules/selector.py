@@ -0,0 +1,168 @@
+# Public Python libraries
+import fnmatch
+import re
+
+# Local Python libraries/modules
+from modules.inventory import Inventory
+from modules.os_matcher import OsMatcher
+
+token_pattern = re.compile(r'''\s*(?:(?P<open>\()|(?P<close>\))|(?P<atom>[A-Za-z_]+:(?:"[^"]*"|'[^']*'|/(?:\\.|[^/\\])*/|[^\s()]+))|(?P<word>[A-Za-z_]+))''')
+selector_kinds = ("group", "tag", "os", "name", "server")
+
+class Selector:
+    def __init__(self, expression: str | list) -> None:
+        '''
+        A "targets:" expression, parsed once into a tree of ("and" | "or", left, right), ("not", operand) and (kind, value) nodes.
+
+        Atoms: group:<name>, tag:<tag>, os:<category>, name:<glob> or name:/<regex>/, server:<name> and all.
+        Operators: not, and, or (in that order of precedence) and parentheses, values with spaces are quoted.
+        A list of expressions selects the devices of any of them.
+        '''
+        if isinstance(expression, list):
+            expression = " or ".join(f"({item})" for item in expression)
+        self.expression = str(expression)
+        self.tokens = Selector.tokenize(self.expression)
+        self.position = 0
+        self.tree = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected '{self.tokens[self.position][1]}' in targets expression: {self.expression}")
+
+    @staticmethod
+    def tokenize(expression: str) -> list[tuple[str, str]]:
+        tokens = []
+        position = 0
+        while position < len(expression.rstrip()):
+            match = token_pattern.match(expression, position)
+            if match is None:
+                raise ValueError(f"Unable to read the targets expression at '{expression[position:].strip()}': {expression}")
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        return tokens
+
+    def peek(self) -> tuple[str, str] | None:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take_word(self, word: str) -> bool:
+        token = self.peek()
+        if token is not None and token[0] == "word" and token[1].lower() == word:
+            self.position += 1
+            return True
+        return False
+
+    def parse_or(self) -> tuple:
+        tree = self.parse_and()
+        while self.take_word("or"):
+            tree = ("or", tree, self.parse_and())
+        return tree
+
+    def parse_and(self) -> tuple:
+        tree = self.parse_not()
+        while self.take_word("and"):
+            tree = ("and", tree, self.parse_not())
+        return tree
+
+    def parse_not(self) -> tuple:
+        if self.take_word("not"):
+            return ("not", self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self) -> tuple:
+        token = self.peek()
+        if token is None:
+            raise ValueError(f"The targets expression ends too early: {self.expression}")
+        self.position += 1
+
+        match token:
+            case ("open", _):
+                tree = self.parse_or()
+                if self.peek() != ("close", ")"):
+                    raise ValueError(f"Missing ')' in targets expression: {self.expression}")
+                self.position += 1
+                return tree
+            case ("word", word) if word.lower() == "all":
+                return ("all",)
+            case ("atom", atom):
+                kind, value = atom.split(":", 1)
+                kind = kind.lower()
+                if kind not in selector_kinds:
+                    raise ValueError(f"Unknown selector '{kind}:', use one of: " + ", ".join(kind + ":" for kind in selector_kinds) + ".")
+                if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+                    value = value[1:-1]
+                elif kind == "name" and len(value) >= 2 and value[0] == value[-1] == "/":
+                    try:
+                        return ("name_regex", re.compile(value[1:-1], re.IGNORECASE))
+                    except re.error as error:
+                        raise ValueError(f"Invalid regex in targets expression '{value}': {error}.")
+                return (kind, value)
+            case (_, text):
+                raise ValueError(f"Unexpected '{text}' in targets expression: {self.expression}")
+
+    def group_names(self) -> set[str] | None:
+        '''
+        The group names of an expression built from group: atoms with "and"/"or" only, None when any other atom, "not" or "all" is in it.
+        '''
+
+        def collect(tree: tuple) -> set[str] | None:
+            match tree:
+                case ("or" | "and", left, right):
+                    left_names, right_names = collect(left), collect(right)
+                    if left_names is None or right_names is None:
+                        return None
+                    return left_names | right_names
+                case ("group", name):
+                    return {name}
+                case _:
+                    return None
+
+        return collect(self.tree)
+
+    def device_ids(self, inventory: Inventory, os_matcher: OsMatcher, ignore_categorisation: bool = False) -> set[str]:
+        '''
+        Evaluate the expression as set operations on the inventory indexes, every device is in the result once.
+        '''
+
+        every_device = None
+
+        def evaluate(tree: tuple) -> set[str]:
+            nonlocal every_device
+            match tree:
+                case ("or", left, right):
+                    return evaluate(left) | evaluate(right)
+                case ("and", left, right):
+                    return evaluate(left) & evaluate(right)
+                case ("not", operand):
+                    if every_device is None:
+                        every_device = set(inventory.by_id)
+                    return every_device - evaluate(operand)
+                case ("all",):
+                    return set(inventory.by_id)
+                case ("group", name):
+                    return {device["device_id"] for device in inventory.group(name) or []}
+                case ("tag", tag):
+                    return set(inventory.ids_with_tag(tag))
+                case ("os", category):
+                    return os_matcher.device_ids(inventory, category, ignore_categorisation)
+                case ("server", server):
+                    return set(inventory.by_server.get(server, set()))
+                case ("name", pattern) if not any(character in pattern for character in "*?["):
+                    return {device["device_id"] for device in inventory.find_by_name(pattern)}
+                case ("name", pattern):
+                    return Selector.names_matching(inventory, re.compile("^" + fnmatch.translate(pattern.lower())))
+                case ("name_regex", pattern):
+                    return Selector.names_matching(inventory, pattern)
+
+        return evaluate(self.tree)
+
+    @staticmethod
+    def names_matching(inventory: Inventory, pattern: re.Pattern) -> set[str]:
+        '''
+        Match the distinct (lowercased) device names instead of every device.
+        '''
+
+        matched = set()
+        for name, devices in inventory.by_name.items():
+            if pattern.search(name):
+                matched.update(device["device_id"] for device in devices)
+        return matched
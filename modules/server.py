@@ -0,0 +1,262 @@
+# Public Python libraries
+import argparse
+import asyncio
+import hmac
+import json
+import meshctrl
+import os
+import yaml
+
+# Local Python libraries/modules
+from modules.console import Console
+from modules.executor import Executor
+from modules.history import History, HistoryStream, OutputSpill
+from modules.inventory import Inventory
+from modules.os_matcher import OsMatcher
+from modules.utilities import Transform, Utilities
+
+class MeshbookServer:
+    def __init__(self, args: argparse.Namespace, session: meshctrl.Session, inventory: Inventory, os_matcher: OsMatcher, history: History, token: str | None = None) -> None:
+        '''
+        Long running daemon that keeps one authenticated session and a warm inventory, and runs meshbook jobs submitted over HTTP.
+        It only listens on a Unix socket (only accessible to its owner) and/or on localhost.
+        With a token (required for localhost) every request needs an "Authorization: Bearer <token>" header.
+
+        POST /run    body: {"meshbook": "<path inside --books-dir>"} or {"book": "<meshbook yaml>"}, optional "name", "group", "device" and "shlex".
+                     The job output is streamed back as NDJSON (the same records as --stream), ending with a "done" or "error" record.
+        GET /health  Inventory size and job counters.
+        '''
+        self.args = args
+        self.session = session
+        self.inventory = inventory
+        self.os_matcher = os_matcher
+        self.history = history
+        self.token = token
+
+        self.job_slots = asyncio.Semaphore(max(1, args.parallel))
+        self.job_counter = 0
+        self.running_jobs = 0
+
+    async def serve(self) -> None:
+        servers = []
+
+        if self.args.socket:
+            if os.path.exists(self.args.socket):
+                os.remove(self.args.socket) # Stale socket of a previous daemon.
+            previous_umask = os.umask(0o177) # The socket is created with 0600 permissions, there is no window before a chmod.
+            try:
+                servers.append(await asyncio.start_unix_server(self.handle_connection, path=self.args.socket))
+            finally:
+                os.umask(previous_umask)
+            Console.print_text(self.args.silent,
+                               "Listening on Unix socket: " + Console.text_color.yellow + self.args.socket + Console.text_color.reset + ".")
+
+        if self.args.listen:
+            servers.append(await asyncio.start_server(self.handle_connection, host="127.0.0.1", port=self.args.listen))
+            Console.print_text(self.args.silent,
+                               "Listening on: " + Console.text_color.yellow + f"http://127.0.0.1:{self.args.listen}" + Console.text_color.reset + ".")
+
+        refresher = asyncio.create_task(self.refresh_inventory())
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            refresher.cancel()
+            for server in servers:
+                server.close()
+            if self.args.socket and os.path.exists(self.args.socket):
+                os.remove(self.args.socket)
+
+    async def refresh_inventory(self) -> None:
+        '''
+        Keep the inventory warm with a full listing every refresh interval, jobs only refresh the groups they target.
+        '''
+
+        while True:
+            await asyncio.sleep(self.args.refresh_interval)
+            self.history.apply_retention() # A daemon runs for weeks, keep its history within the limits as well.
+            try:
+                self.inventory = await Transform.compile_group_list(self.session)
+                Console.print_text(self.args.silent, f"Inventory refreshed, {len(self.inventory)} devices.")
+            except (asyncio.TimeoutError, meshctrl.exceptions.MeshCtrlError) as message:
+                Console.print_text(self.args.silent, Console.text_color.yellow + f"Inventory refresh failed, keeping the previous one: {message}")
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict, bytes]:
+        '''
+        Minimal HTTP/1.1 request parsing, enough for curl and the usual HTTP clients.
+        Raises a ValueError for a Content-Length that is not a number.
+        '''
+
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        method, path = (request_line.split(" ") + ["", ""])[:2]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        try:
+            content_length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise ValueError("Content-Length is not a number.")
+
+        body = b""
+        if content_length > 0:
+            body = await reader.readexactly(content_length)
+        return method.upper(), path, headers, body
+
+    def authorized(self, headers: dict) -> bool:
+        if self.token is None:
+            return True
+        return hmac.compare_digest(headers.get("authorization", "").encode(), f"Bearer {self.token}".encode())
+
+    def book_path(self, meshbook_file: str) -> str:
+        '''
+        Resolve the path of a job against --books-dir, a path outside of it (symlinks included) raises a ValueError.
+        '''
+
+        if not self.args.books_dir:
+            raise ValueError("Running a meshbook by path needs --books-dir on the daemon, send its content as 'book' instead.")
+
+        books_dir = os.path.realpath(self.args.books_dir)
+        path = os.path.realpath(os.path.join(books_dir, meshbook_file))
+        if os.path.commonpath([books_dir, path]) != books_dir:
+            raise ValueError(f"{meshbook_file} is not inside the books directory of the daemon.")
+        return path
+
+    @staticmethod
+    async def write_response(writer: asyncio.StreamWriter, status: str, content_type: str, body: str | None = None) -> None:
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nConnection: close\r\n\r\n".encode())
+        if body is not None:
+            writer.write(body.encode())
+        await writer.drain()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                method, path, headers, body = await MeshbookServer.read_request(reader)
+            except ValueError as message:
+                await MeshbookServer.write_response(writer, "400 Bad Request", "application/json", json.dumps({"record": "error", "message": str(message)}) + "\n")
+                return
+
+            if not self.authorized(headers):
+                await MeshbookServer.write_response(writer, "401 Unauthorized", "application/json", json.dumps({"record": "error", "message": "Missing or wrong 'Authorization: Bearer <token>' header."}) + "\n")
+                return
+
+            match (method, path):
+                case ("GET", "/health"):
+                    await MeshbookServer.write_response(writer, "200 OK", "application/json", json.dumps({
+                        "status": "ok",
+                        "inventory": len(self.inventory),
+                        "jobs_started": self.job_counter,
+                        "jobs_running": self.running_jobs
+                    }) + "\n")
+
+                case ("POST", "/run"):
+                    try:
+                        request = json.loads(body or b"{}")
+                    except ValueError:
+                        await MeshbookServer.write_response(writer, "400 Bad Request", "application/json", json.dumps({"record": "error", "message": "Body is not valid JSON."}) + "\n")
+                        return
+                    if not isinstance(request, dict):
+                        await MeshbookServer.write_response(writer, "400 Bad Request", "application/json", json.dumps({"record": "error", "message": "Body has to be a JSON object."}) + "\n")
+                        return
+
+                    await MeshbookServer.write_response(writer, "200 OK", "application/x-ndjson")
+                    await self.run_job(request, writer)
+
+                case _:
+                    await MeshbookServer.write_response(writer, "404 Not Found", "application/json", json.dumps({"record": "error", "message": "Use POST /run or GET /health."}) + "\n")
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass # Caller went away, the job (if any) still finished and was written to history.
+
+        finally:
+            writer.close()
+
+    async def run_job(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        self.job_counter += 1
+        job_number = self.job_counter
+
+        def send(line: str) -> None:
+            if not writer.is_closing():
+                writer.write(line.encode())
+
+        try:
+            if "book" in request:
+                meshbook = await Utilities.compile_book_content(request["book"])
+                meshbook_file = request.get("name", "inline")
+            elif "meshbook" in request:
+                meshbook_file = self.book_path(str(request["meshbook"]))
+                meshbook = await Utilities.compile_book(meshbook_file)
+            else:
+                send(json.dumps({"record": "error", "message": "Give either 'meshbook' (path) or 'book' (yaml content)."}) + "\n")
+                return
+
+            Executor.check_amounts(meshbook) # Before the job takes a slot, a bad value would otherwise stop it halfway.
+            Utilities.apply_target_override(meshbook, request.get("group", ""), request.get("device", ""))
+            Console.print_text(self.args.silent, f"Job {job_number}: {meshbook_file}.")
+
+            async with self.job_slots:
+                self.running_jobs += 1
+                try:
+                    if self.args.inventory_state == "live":
+                        self.inventory = await Utilities.refresh_targets(self.args.silent, self.session, [meshbook], self.inventory, self.os_matcher)
+
+                    compiled_device_list = await Utilities.gather_targets(self.args.silent, meshbook, self.inventory, self.os_matcher)
+                    if len(compiled_device_list["target_list"]) == 0:
+                        send(json.dumps({"record": "error", "message": "No targets found or targets unreachable."}) + "\n")
+                        return
+
+                    stitched_file = None
+                    spill = None
+                    if not self.args.nohistory:
+                        stitched_file = f"{self.history.history_directory}/{self.history.file_stem(Utilities.history_name(meshbook_file))}_job{job_number}.ndjson"
+                        spill = OutputSpill(stitched_file.removesuffix(".ndjson") + "_output")
+
+                    if self.history.store is not None and not self.args.nohistory:
+                        stitched_file = self.history.store.database_file
+                        stream = self.history.store.open_run(meshbook_file, meshbook["tasks"], HistoryStream(True, None, meshbook_file, meshbook["tasks"], None, send))
+                    else:
+                        stream = HistoryStream(True, stitched_file, meshbook_file, meshbook["tasks"], None, send)
+
+                    manifest_entry = None
+                    if self.history.store is None and not self.args.nohistory: # Registered right away, an interrupted job is still covered by the retention.
+                        spill = OutputSpill(stream.stitched_file.removesuffix(".ndjson") + "_output") # Named after the file that was created, so it is not shared with another job.
+                        manifest_entry = self.history.register(stream.stitched_file, spill.requested_directory)
+                    try:
+                        await Executor.execute_meshbook(self.args.silent,
+                                                        request.get("shlex", self.args.shlex),
+                                                        self.session,
+                                                        compiled_device_list,
+                                                        meshbook,
+                                                        self.inventory,
+                                                        stream,
+                                                        spill)
+                    finally:
+                        stream.close()
+                    if self.history.store is None and not self.args.nohistory:
+                        stitched_file = stream.stitched_file
+                        self.history.update_entry(manifest_entry, spill.spill_directory)
+                    elif not self.args.nohistory:
+                        self.history.store.set_spill_directory(stream.run_id, spill.spill_directory)
+
+                    send(json.dumps({"record": "done", "history": stitched_file}) + "\n")
+                finally:
+                    self.running_jobs -= 1
+
+        except (OSError, ValueError, KeyError, yaml.YAMLError, asyncio.TimeoutError, meshctrl.exceptions.MeshCtrlError) as message:
+            Console.print_text(self.args.silent, Console.text_color.red + f"Job {job_number} failed: {message}")
+            send(json.dumps({"record": "error", "message": str(message)}) + "\n")
+
+        except ExceptionGroup as error: # The tasks of a job run in a TaskGroup, errors of run_command arrive wrapped in a group.
+            message = Utilities.describe_error(error)
+            Console.print_text(self.args.silent, Console.text_color.red + f"Job {job_number} failed: {message}")
+            send(json.dumps({"record": "error", "message": message}) + "\n")
+
+        finally:
+            if not writer.is_closing():
+                await writer.drain()
@@ -0,0 +1,51 @@
+# Public Python libraries
+from __future__ import annotations
+import asyncio
+import math
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import meshctrl
+
+class SessionPool():
+    def __init__(self, sessions: list[meshctrl.Session]) -> None:
+        '''
+        Several authenticated sessions to the same MeshCentral server, used like a single meshctrl.Session.
+        A run_command for many devices is split over all sessions and the responses are merged again,
+        so the JSON framing and parsing of a large fleet is spread over several websockets.
+        '''
+        self.sessions = sessions
+        self.next_session = 0
+
+    def rotate(self) -> list[meshctrl.Session]:
+        '''
+        The sessions, starting at a different one every call, so calls for a single device are spread over the pool as well.
+        '''
+
+        start = self.next_session
+        self.next_session = (self.next_session + 1) % len(self.sessions)
+        return self.sessions[start:] + self.sessions[:start]
+
+    async def list_devices(self, *args, **kwargs) -> list:
+        return await self.sessions[0].list_devices(*args, **kwargs)
+
+    async def run_command(self, nodeids, command, **kwargs) -> dict:
+        if isinstance(nodeids, str):
+            nodeids = [nodeids]
+
+        shard_size = max(1, math.ceil(len(nodeids) / len(self.sessions)))
+        shards = [nodeids[index:index + shard_size] for index in range(0, len(nodeids), shard_size)]
+        sessions = self.rotate()
+
+        if len(shards) <= 1:
+            return await sessions[0].run_command(nodeids, command, **kwargs)
+
+        responses = await asyncio.gather(*(session.run_command(shard, command, **kwargs) for session, shard in zip(sessions, shards)))
+
+        merged = {}
+        for response in responses:
+            merged.update(response)
+        return merged
+
+    async def close(self) -> None:
+        await asyncio.gather(*(session.close() for session in self.sessions))
@@ -1,12 +1,70 @@
 # Public Python libraries
+from __future__ import annotations
 import argparse
+import asyncio
 from configparser import ConfigParser
-import meshctrl
+import glob
+import math
 import os
+import re
 import shlex
-import yaml
+from typing import TYPE_CHECKING
 
 from modules.console import Console
+from modules.inventory import Inventory, InventoryCache
+from modules.os_matcher import OsMatcher
+from modules.selector import Selector
+
+if TYPE_CHECKING: # Annotations only, the process pool is imported when it is created and the sessions come from meshbook.py.
+    from concurrent.futures import ProcessPoolExecutor
+    import meshctrl
+
+offload_threshold = 16384 # Results of at least this many characters are shlexed in the process pool, smaller ones are cheaper to do in place.
+device_facts = ("device_id", "device_name", "device_os", "device_tags", "group", "server") # Placeholders filled in per device by the Executor.
+
+class Template:
+    placeholder = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*(?:\s*\|\s*raw)?)\s*\}\}")
+    compiled: dict[str, "Template"] = {}
+
+    def __init__(self, text: str) -> None:
+        '''
+        A text with "{{ name }}" placeholders, split once into its literal parts and placeholders so rendering is a single join.
+        parts alternates literal text (even positions) and placeholder names (odd positions), originals keeps the placeholder as written
+        and raw marks the placeholders written as "{{ name | raw }}".
+        '''
+        self.text = text
+        self.parts = Template.placeholder.split(text)
+        self.originals = [match.group(0) for match in Template.placeholder.finditer(text)]
+        self.raw = ["|" in part for part in self.parts[1::2]]
+        self.parts[1::2] = [part.split("|")[0].strip() for part in self.parts[1::2]]
+        self.fields = set(self.parts[1::2])
+
+    @staticmethod
+    def compile(text: str) -> "Template":
+        if text not in Template.compiled:
+            Template.compiled[text] = Template(text)
+        return Template.compiled[text]
+
+    def render(self, values: dict, quote=None) -> str:
+        '''
+        Fill in the placeholders in one pass, a placeholder without a value is left as it was written.
+        quote (a function) is applied to every value of a placeholder that is not marked "| raw".
+        '''
+
+        if not self.fields:
+            return self.text
+
+        rendered = []
+        for index, part in enumerate(self.parts):
+            if index % 2 == 0:
+                rendered.append(part)
+            elif part in values and quote is not None and not self.raw[index // 2]:
+                rendered.append(quote(str(values[part])))
+            elif part in values:
+                rendered.append(str(values[part]))
+            else:
+                rendered.append(self.originals[index // 2])
+        return "".join(rendered)
 
 '''
 Creation and compilation of the MeshCentral nodes list (list of all nodes available to the user in the configuration) is handled in the following section.
@@ -14,13 +72,7 @@ Creation and compilation of the MeshCentral nodes list (list of all nodes availa
 
 class Utilities:
     @staticmethod
-    async def load_config(args: argparse.Namespace,
-                          segment: str = 'meshcentral-account') -> dict:
-        '''
-        Function that loads the segment from the config.conf (by default) file and returns the it in a dict.
-        '''
-
-        conf_file = args.conf
+    def read_config(conf_file: str) -> ConfigParser:
         if not os.path.exists(conf_file):
             print(f'Missing config file {conf_file}. Provide an alternative path.')
             os._exit(1)
@@ -31,6 +83,17 @@ class Utilities:
         except Exception as err:
             print(f"Error reading configuration file '{conf_file}': {err}")
             os._exit(1)
+        return config
+
+    @staticmethod
+    async def load_config(args: argparse.Namespace,
+                          segment: str = 'meshcentral-account') -> dict:
+        '''
+        Function that loads the segment from the config.conf (by default) file and returns the it in a dict.
+        '''
+
+        conf_file = args.conf
+        config = Utilities.read_config(conf_file)
 
         if segment not in config:
             print(f'Segment "{segment}" not found in config file {conf_file}.')
@@ -38,6 +101,39 @@ class Utilities:
 
         return dict(config[segment])
 
+    @staticmethod
+    async def load_servers(args: argparse.Namespace,
+                           segment: str = 'meshcentral-account') -> dict[str, dict]:
+        '''
+        Load every MeshCentral server from the config file, as server name -> credentials.
+        Next to (or instead of) the [meshcentral-account] segment, every [meshcentral-account <name>] segment adds a server called <name>.
+        The plain segment is named after its hostname.
+        '''
+
+        conf_file = args.conf
+        config = Utilities.read_config(conf_file)
+
+        servers = {}
+        for section in config.sections():
+            if section == segment:
+                servers[config[section].get("hostname", section)] = dict(config[section])
+            elif section.startswith(segment + " "):
+                servers[section[len(segment) + 1:].strip()] = dict(config[section])
+
+        if len(servers) == 0:
+            print(f'Segment "{segment}" not found in config file {conf_file}.')
+            os._exit(1)
+
+        return servers
+
+    @staticmethod
+    def servers_hostname(servers: dict[str, dict]) -> str:
+        '''
+        The hostname the inventory cache is kept under, several servers share a single cache file.
+        '''
+
+        return "+".join(sorted(credentials.get("hostname", "") for credentials in servers.values()))
+
     @staticmethod
     async def compile_book(meshbook_file: str) -> dict:
         '''
@@ -46,19 +142,89 @@ class Utilities:
 
         with open(meshbook_file, 'r') as f:
             meshbook = f.read()
-        meshbook = await Transform.replace_placeholders(yaml.safe_load(meshbook))
-        return meshbook
+        return await Utilities.compile_book_content(meshbook)
+
+    @staticmethod
+    async def compile_book_content(meshbook: str) -> dict:
+        '''
+        Same as compile_book, for a meshbook that is already in memory (like one submitted to the daemon).
+        '''
+
+        import yaml
+
+        return await Transform.replace_placeholders(yaml.safe_load(meshbook))
+
+    @staticmethod
+    def apply_target_override(meshbook: dict, group: str = "", device: str = "") -> None:
+        '''
+        A group or device override replaces whatever the meshbook targets.
+        '''
+
+        if group != "":
+            meshbook["group"] = group
+            if "device" in meshbook:
+                del meshbook["device"]
+            if "devices" in meshbook:
+                del meshbook["devices"]
+            if "targets" in meshbook:
+                del meshbook["targets"]
+        elif device != "":
+            meshbook["device"] = device
+            if "group" in meshbook:
+                del meshbook["group"]
+            if "groups" in meshbook:
+                del meshbook["groups"]
+            if "targets" in meshbook:
+                del meshbook["targets"]
+
+    @staticmethod
+    def resolve_meshbooks(meshbook_path: str) -> list[str]:
+        '''
+        Turn the --meshbook value into the list of meshbook files to run, in order.
+        Accepts a single meshbook, a directory (every .yaml/.yml file in it), a glob pattern or a manifest file with a "meshbooks" list.
+        Manifest entries are relative to the manifest and can be any of the above (except another manifest).
+        '''
+
+        if os.path.isdir(meshbook_path):
+            return sorted(glob.glob(os.path.join(meshbook_path, "*.yaml")) + glob.glob(os.path.join(meshbook_path, "*.yml")))
+
+        if any(character in meshbook_path for character in "*?["):
+            return sorted(path for path in glob.glob(meshbook_path) if os.path.isfile(path))
+
+        if not os.path.isfile(meshbook_path):
+            return []
+
+        import yaml
+
+        with open(meshbook_path, 'r') as f:
+            content = yaml.safe_load(f)
+
+        if isinstance(content, dict) and isinstance(content.get("meshbooks"), list):
+            manifest_directory = os.path.dirname(meshbook_path)
+            meshbook_files = []
+            for entry in content["meshbooks"]:
+                entry_path = os.path.join(manifest_directory, str(entry))
+                if os.path.isfile(entry_path):
+                    meshbook_files.append(entry_path)
+                else:
+                    meshbook_files.extend(Utilities.resolve_meshbooks(entry_path))
+            return meshbook_files
+
+        return [meshbook_path]
+
+    @staticmethod
+    def history_name(meshbook_file: str) -> str:
+        return os.path.splitext(os.path.basename(meshbook_file))[0]
 
     @staticmethod
     async def gather_targets(silent: bool,
                             meshbook: dict,
-                            group_list: dict[str, list[dict]],
-                            os_categories: dict) -> dict:
+                            inventory: Inventory,
+                            os_matcher: OsMatcher) -> dict:
         """
-        Finds target devices based on meshbook criteria (device, devices, group or groups).
+        Finds target devices based on meshbook criteria (targets, device, devices, group or groups).
         """
 
-        group_list = {k.lower(): v for k, v in group_list.items()}  # Normalize keys
         target_list = []
         offline_list = []
 
@@ -75,8 +241,8 @@ class Utilities:
         async def process_device_helper(device):
             processed = await Utilities.process_device(
                 device,
-                group_list,
-                os_categories,
+                inventory,
+                os_matcher,
                 target_os,
                 ignore_categorisation,
                 target_tag
@@ -85,22 +251,35 @@ class Utilities:
 
         async def process_group_helper(group):
             processed = await Utilities.filter_targets(
-                group, os_categories, target_os, ignore_categorisation, target_tag
+                group, os_matcher, target_os, ignore_categorisation, target_tag
             )
             await add_processed_devices(processed)
 
         '''
-        Groups receive the first priority, then device targets.
+        A targets expression receives the first priority, then groups, then device targets.
         '''
         match meshbook:
+            case {"targets": expression}:
+                selected = Selector(expression).device_ids(inventory, os_matcher, ignore_categorisation)
+                if target_os:
+                    selected &= os_matcher.device_ids(inventory, target_os, ignore_categorisation)
+                if target_tag:
+                    selected &= inventory.ids_with_tag(target_tag)
+
+                for device_id in sorted(selected, key=lambda device_id: (inventory.name_of(device_id).lower(), device_id)):
+                    if inventory.get(device_id)["reachable"]:
+                        target_list.append(device_id)
+                    else:
+                        offline_list.append(device_id)
+
             case {"group": pseudo_target}:
                 if isinstance(pseudo_target, str):
-                    pseudo_target = pseudo_target.lower()
+                    group = inventory.group(pseudo_target)
 
-                    if pseudo_target in group_list:
-                        await process_group_helper(group_list[pseudo_target])
+                    if group is not None:
+                        await process_group_helper(group)
 
-                    elif pseudo_target not in group_list:
+                    else:
                         Console.print_text(
                             silent,
                             Console.text_color.yellow + "Targeted group not found on the MeshCentral server."
@@ -124,11 +303,11 @@ class Utilities:
                     )
                 elif isinstance(pseudo_target, list):
                     for sub_group in pseudo_target:
-                        sub_group = sub_group.lower()
-                        if sub_group in group_list:
-                            await process_group_helper(group_list[sub_group])
+                        group = inventory.group(sub_group)
+                        if group is not None:
+                            await process_group_helper(group)
                 elif isinstance(pseudo_target, str) and pseudo_target.lower() == "all":
-                    for group in group_list.values():
+                    for group in inventory.groups.values():
                         await process_group_helper(group)
                 else:
                     Console.print_text(
@@ -168,31 +347,96 @@ class Utilities:
         return {"target_list": target_list, "offline_list": offline_list}
 
     @staticmethod
-    def get_os_variants(target_category: str,
-                        os_map: dict) -> set:
+    async def load_inventory(silent: bool,
+                             session: meshctrl.Session,
+                             meshbooks: list[dict],
+                             cache: InventoryCache,
+                             force_refresh: bool = False,
+                             connection_state: str = "live",
+                             os_matcher: OsMatcher | None = None) -> Inventory:
         '''
-        Extracts all OS names under a given category if it exists.
+        Use the cached inventory when it is fresh enough, otherwise fetch the full device list and cache it.
+        With connection_state "live" the groups the meshbooks target are re-fetched from the session, with "cache" the cached state is trusted.
         '''
 
-        for key, value in os_map.items():
-            if key == target_category:
+        inventory = None
+        if not force_refresh:
+            inventory = cache.load()
+
+        if inventory is None:
+            inventory = await Transform.compile_group_list(session)
+            cache.save(inventory)
+            return inventory
+
+        if connection_state == "live":
+            inventory = await Utilities.refresh_targets(silent, session, meshbooks, inventory, os_matcher)
+            if inventory.fetched_fully:
+                cache.save(inventory)
+
+        return inventory
+
+    @staticmethod
+    async def refresh_targets(silent: bool,
+                              session: meshctrl.Session,
+                              meshbooks: list[dict],
+                              inventory: Inventory,
+                              os_matcher: OsMatcher | None = None) -> Inventory:
+        '''
+        Bring the connection state of the groups the meshbooks target up to date.
+        Returns a freshly fetched inventory when the targets can not be narrowed down to groups, otherwise the given (updated) one.
+        '''
 
-                if isinstance(value, dict):  # Expand nested categories
-                    os_set = set()
+        meshnames = set()
+        for meshbook in meshbooks:
+            book_meshnames = Utilities.target_groups(meshbook, inventory, os_matcher)
+            if book_meshnames is None:
+                meshnames = None
+                break
+            meshnames.update(book_meshnames)
 
-                    for sub_target_cat in value:
-                        os_set.update(Utilities.get_os_variants(sub_target_cat, value))
+        if meshnames is None or (len(inventory.groups) > 1 and meshnames >= set(inventory.groups)): # Targets span the whole server, a full listing is just as cheap.
+            return await Transform.compile_group_list(session)
 
-                    return os_set
+        if len(meshnames) > 0:
+            Console.print_text(silent, f"Refreshing {len(meshnames)} targeted group(s) from MeshCentral.")
+            await inventory.refresh_groups(session, meshnames)
+        return inventory
 
-                elif isinstance(value, list):  # Direct OS list
-                    return set(value)
+    @staticmethod
+    def target_groups(meshbook: dict, inventory: Inventory, os_matcher: OsMatcher | None = None) -> set[str] | None:
+        '''
+        Names of the groups (as known to MeshCentral) that hold the meshbook targets, None when that can not be narrowed down.
+        A targets expression of only group: atoms names its groups, any other expression is evaluated on the cached inventory
+        and narrows down to the groups of the devices it selects there (devices added or retagged since are seen after the next full listing).
+        '''
 
-        return set()
+        match meshbook:
+            case {"targets": expression}:
+                selector = Selector(expression)
+                group_names = selector.group_names()
+                if group_names is not None:
+                    wanted = {name.lower() for name in group_names}
+                elif os_matcher is None:
+                    return None
+                else:
+                    selected = selector.device_ids(inventory, os_matcher, meshbook.get("ignore_categorisation", False))
+                    return {inventory.group_of[device_id] for device_id in selected}
+            case {"group": str(pseudo_target)}:
+                wanted = {pseudo_target.lower()}
+            case {"groups": list(pseudo_target)}:
+                wanted = {str(group).lower() for group in pseudo_target}
+            case {"device": str(pseudo_target)}:
+                return {inventory.group_of[device["device_id"]] for device in inventory.find_by_name(pseudo_target)}
+            case {"devices": list(pseudo_target)}:
+                return {inventory.group_of[device["device_id"]] for name in pseudo_target for device in inventory.find_by_name(str(name))}
+            case _:
+                return None
+
+        return {meshname for meshname in inventory.groups if meshname.lower() in wanted}
 
     @staticmethod
     async def filter_targets(devices: list[dict],
-                             os_categories: dict,
+                             os_matcher: OsMatcher,
                              target_os: str = "",
                              ignore_categorisation: bool = False,
                              target_tag: str = "") -> dict:
@@ -202,28 +446,13 @@ class Utilities:
 
         valid_devices = []
         offline_devices = []
-        allowed_os = set()
-
-        # Identify correct OS filtering scope
-        for key in os_categories:
-            if key == target_os:
-                allowed_os = Utilities.get_os_variants(target_os, os_categories)
-                break  # Stop searching once a match is found
-
-            if isinstance(os_categories[key], dict) and target_os in os_categories[key]:
-                allowed_os = Utilities.get_os_variants(target_os, os_categories[key])
-                break  # Stop searching once a match is found
 
         for device in devices: # Filter out unwanted or unreachable devices.
             if target_tag and target_tag not in device["device_tags"]:
                 continue
 
-            if not ignore_categorisation:
-                if device["device_os"] not in allowed_os:
-                    continue                
-            else:
-                if target_os not in device["device_os"]:
-                    continue
+            if not os_matcher.matches(device["device_os"], target_os, ignore_categorisation):
+                continue
 
             if not device["reachable"]:
                 offline_devices.append(device["device_id"])
@@ -238,34 +467,50 @@ class Utilities:
 
     @staticmethod
     async def process_device(device: str,
-                            group_list: dict,
-                            os_categories: dict,
+                            inventory: Inventory,
+                            os_matcher: OsMatcher,
                             target_os: str,
                             ignore_categorisation: bool,
                             target_tag: str) -> dict:
         """
-        Processes a single device or pseudo-target against group_list,
+        Processes a single device or pseudo-target against the inventory,
         filters matches by OS and tags, and adds processed devices.
         """
-        matched_devices = []
-        pseudo_target = device.lower()
-
-        # Find devices that match the pseudo_target
-        for group in group_list:
-            for dev in group_list[group]:
-                if dev["device_name"].lower() == pseudo_target:
-                    matched_devices.append(dev)
+        matched_devices = inventory.find_by_name(device)
 
         # If matches found, filter them and add processed devices
         if matched_devices:
             processed = await Utilities.filter_targets(
-                matched_devices, os_categories, target_os, ignore_categorisation, target_tag
+                matched_devices, os_matcher, target_os, ignore_categorisation, target_tag
             )
             return processed
 
         # No matches found
         return {"valid_devices": [], "offline_devices": []}
 
+    @staticmethod
+    def resolve_amount(value: int | str, total: int) -> int:
+        '''
+        Turn an absolute count (10) or a percentage ("25%") of the total into a device count of at least 1.
+        '''
+
+        if isinstance(value, str) and value.strip().endswith("%"):
+            percentage = float(value.strip()[:-1])
+            amount = math.ceil(total * percentage / 100)
+        else:
+            amount = int(value)
+        return max(1, amount)
+
+    @staticmethod
+    def describe_error(error: BaseException) -> str:
+        '''
+        One line for an error, the errors inside an exception group (raised from a TaskGroup) are listed instead of the group.
+        '''
+
+        if isinstance(error, BaseExceptionGroup):
+            return "; ".join(Utilities.describe_error(sub_error) for sub_error in error.exceptions)
+        return f"{type(error).__name__}: {error}"
+
     @staticmethod
     def path_exist(path: str) -> bool:
         return os.path.exists(path)
@@ -281,93 +526,155 @@ class Utilities:
         return "Undefined"
 
 class Transform:
+    shlex_pool: ProcessPoolExecutor | None = None # Created on the first large shlex job.
+
     @staticmethod
     def process_shell_response(enable_shlex: bool, meshbook_result: dict) -> dict:
         for task_name, task_data in meshbook_result.items():
-            if task_name == "Offline": # Failsafe do not parse Offline section, its simple
+            if task_name in ("Offline", "Skipped"): # Failsafe do not parse the Offline and Skipped sections, they are simple
                 continue
 
             for node_responses in task_data["data"]:
-                task_result = node_responses["result"].splitlines()
-                
-                if enable_shlex:
-                    for index, line in enumerate(task_result):
-                        line = shlex.split(line)
-                        task_result[index] = line
-
-                clean_output = []
-                for line in task_result:
-                    if len(line) > 0:
-                        clean_output.append(line)
-
-                node_responses["result"] = clean_output
+                Transform.process_device_response(enable_shlex, node_responses)
         return meshbook_result
 
     @staticmethod
-    async def translate_nodeid_to_name(target_id: str, group_list: dict) -> str:
+    def process_device_response(enable_shlex: bool, node_responses: dict) -> dict:
         '''
-        Simple function that looks up nodeid to the human-readable name if existent - otherwise return None.
+        Split the result of a single device into lines (shlexed when asked for) and drop the empty ones.
         '''
 
-        for group in group_list:
-            for device in group_list[group]:
-                if device["device_id"] == target_id:
-                    return device["device_name"]
-        return ""
+        node_responses["result"] = Transform.split_result(enable_shlex, node_responses["result"])
+        return node_responses
+
+    @staticmethod
+    def split_result(enable_shlex: bool, result: str) -> list:
+        task_result = result.splitlines()
+
+        if enable_shlex:
+            for index, line in enumerate(task_result):
+                line = shlex.split(line)
+                task_result[index] = line
+
+        clean_output = []
+        for line in task_result:
+            if len(line) > 0:
+                clean_output.append(line)
+        return clean_output
+
+    @staticmethod
+    async def process_device_response_offloaded(enable_shlex: bool, node_responses: dict) -> dict:
+        '''
+        Same as process_device_response, called for every response as soon as it arrives.
+        Large results are shlexed in a process pool, so the event loop keeps receiving the other responses meanwhile.
+        '''
+
+        if not enable_shlex or len(node_responses["result"]) < offload_threshold:
+            return Transform.process_device_response(enable_shlex, node_responses)
+
+        if Transform.shlex_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            Transform.shlex_pool = ProcessPoolExecutor()
+        node_responses["result"] = await asyncio.get_running_loop().run_in_executor(Transform.shlex_pool,
+                                                                                   Transform.split_result,
+                                                                                   enable_shlex,
+                                                                                   node_responses["result"])
+        return node_responses
+
+    @staticmethod
+    def close_shlex_pool() -> None:
+        if Transform.shlex_pool is not None:
+            Transform.shlex_pool.shutdown()
+            Transform.shlex_pool = None
+
+    @staticmethod
+    async def translate_nodeid_to_name(target_id: str, inventory: Inventory) -> str:
+        '''
+        Simple function that looks up nodeid to the human-readable name if existent - otherwise return an empty string.
+        '''
+
+        return inventory.name_of(target_id)
     
     @staticmethod
     async def replace_placeholders(meshbook: dict) -> dict:
         '''
         Replace the placeholders in both name and command fields of the tasks. According to the variables defined in the variables list.
+        Placeholders that are not a variable (like the device facts) are left in place, the Executor fills those in per device.
         '''
 
         variables = {}
         if "variables" in meshbook and isinstance(meshbook["variables"], list):
             for var in meshbook["variables"]:
-                var_name = var["name"]
-                var_value = var["value"]
-                variables[var_name] = var_value
+                variables[var["name"]] = var["value"]
 
         else:
             return meshbook
 
         for task in meshbook.get("tasks", []):
-            task_name = task.get("name")
+            task["name"] = Template(task.get("name")).render(variables)
+            task["command"] = Template(task.get("command")).render(variables)
+
+        return meshbook
 
-            for var_name, var_value in variables.items():
-                placeholder = f"{{{{ {var_name} }}}}"
-                task_name = task_name.replace(placeholder, var_value)
+    @staticmethod
+    def device_facts(device_id: str, inventory: Inventory) -> dict:
+        '''
+        The values of the per device placeholders ({{ device_name }}, {{ device_os }}, {{ device_tags }}, {{ group }} ...).
+        '''
 
-            task["name"] = task_name
+        device = inventory.get(device_id) or {}
+        return {
+            "device_id": device_id,
+            "device_name": device.get("device_name", ""),
+            "device_os": device.get("device_os", ""),
+            "device_tags": ",".join(device.get("device_tags") or []),
+            "group": inventory.group_of.get(device_id, ""),
+            "server": device.get("server", "")
+        }
 
-            command = task.get("command")
-            for var_name, var_value in variables.items():
-                placeholder = f"{{{{ {var_name} }}}}"  # Create the placeholder string like "{{ host1 }}"
-                command = command.replace(placeholder, var_value)
+    @staticmethod
+    def device_shell(device_os: str, powershell: bool = False) -> str:
+        '''
+        The shell a command runs in on a device: "powershell" for powershell meshbooks, "cmd" on other Windows devices and "sh" everywhere else.
+        '''
 
-            task["command"] = command
+        if powershell:
+            return "powershell"
+        if "windows" in device_os.lower():
+            return "cmd"
+        return "sh"
 
-        return meshbook
-    
     @staticmethod
-    async def compile_group_list(session: meshctrl.Session) -> dict:
+    def quote_fact(value: str, shell: str) -> str:
         '''
-        Function that retrieves the devices from MeshCentral and compiles it into a efficient list.
+        Quote a device fact as a single argument for the shell, so a device name or tag set in MeshCentral can not add shell syntax to a command.
+        PowerShell takes the typographic single quotes as quotes as well. cmd has no escape inside double quotes, so the
+        characters that can end the quotes or expand something there (", %, ! and line breaks) are left out.
         '''
 
-        devices_response = await session.list_devices(details=False, timeout=10)
+        match shell:
+            case "powershell":
+                return "'" + re.sub(r"(['\u2018\u2019\u201a\u201b])", r"\1\1", value) + "'"
+            case "cmd":
+                return '"' + re.sub(r'["%!\r\n]', "", value) + '"'
+            case _:
+                return shlex.quote(value)
 
-        local_device_list = {}
-        for device in devices_response:
-            if device.meshname not in local_device_list:
-                local_device_list[device.meshname] = []
+    @staticmethod
+    def unknown_placeholders(meshbook: dict) -> set[str]:
+        '''
+        Placeholders in the task commands that are neither a variable nor a device fact, they would reach the devices as written.
+        '''
 
-            local_device_list[device.meshname].append({
-                "device_id": device.nodeid,
-                "device_name": device.name,
-                "device_os": device.os_description,
-                "device_tags": device.tags,
-                "reachable": device.connected
-            })
+        unknown = set()
+        for task in meshbook.get("tasks", []):
+            unknown |= Template.compile(task.get("command", "")).fields - set(device_facts)
+        return unknown
+    
+    @staticmethod
+    async def compile_group_list(session: meshctrl.Session) -> Inventory:
+        '''
+        Function that retrieves the devices from MeshCentral and compiles it into an indexed inventory.
+        '''
 
-        return local_device_list
\ No newline at end of file
+        return await Inventory.from_session(session)